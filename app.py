@@ -1,10 +1,17 @@
 from flask import (Flask, render_template, request, redirect, session, 
-                   url_for, flash, jsonify, Response, send_from_directory)
-from flask_babel import Babel, gettext as _, lazy_gettext as _l, get_locale as get_babel_locale, \
+                   url_for, flash, jsonify, Response, send_from_directory, g)
+from flask_babel import Babel, gettext as _, lazy_gettext as _l, ngettext, get_locale as get_babel_locale, \
                         format_datetime, format_date, format_time, format_timedelta, format_number
 from functools import wraps
+import bisect
+import click
+from collections import OrderedDict
+import json
 import os
+import queue
 import re
+import select
+import threading
 import requests
 import urllib.parse
 import time
@@ -13,11 +20,12 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from datetime import datetime, timezone, timedelta
 from werkzeug.security import generate_password_hash
+from markupsafe import escape
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine, event, text, or_, and_, desc, asc, func, union_all
+from sqlalchemy import create_engine, event, text, or_, and_, desc, asc, func, union_all, case
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import joinedload, aliased
+from sqlalchemy.orm import joinedload, aliased, Session as OrmSession
 from sqlalchemy.exc import IntegrityError
 
 app = Flask(__name__)
@@ -35,6 +43,14 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     "pool_pre_ping": True,
 }
+if DATABASE_URL.startswith('postgresql'):
+    # Con workers de gevent (gunicorn.conf.py) hay muchas peticiones concurrentes por proceso; las conexiones
+    # SSE no retienen conexión a la base de datos, así que el pool solo dimensiona las peticiones normales.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    )
 
 db = SQLAlchemy(app)
 
@@ -58,6 +74,13 @@ class User(db.Model):
     ban_reason = db.Column(db.Text, nullable=True)
     muted_until = db.Column(db.DateTime(timezone=True), nullable=True)
     accepted_policies = db.Column(db.Boolean, default=False, nullable=False)
+    # Cuentas con demasiados contactos no escriben en los timelines ajenos; sus lectores las leen al vuelo.
+    timeline_fanout_on_read = db.Column(db.Boolean, default=False, nullable=False)
+    # Desde cuándo: al volver al fan-out en escritura se copia a los timelines lo publicado en ese periodo.
+    timeline_fanout_on_read_since = db.Column(db.DateTime(timezone=True), nullable=True)
+    # Contadores de la barra de navegación; se mantienen en cada escritura (ver reconcile-unread-counters).
+    unread_notifications_count = db.Column(db.Integer, default=0, nullable=False)
+    unread_messages_count = db.Column(db.Integer, default=0, nullable=False)
     
     profile = db.relationship('Profile', backref='user', uselist=False, cascade="all, delete-orphan")
     posts = db.relationship('Post', backref='author', lazy='dynamic', cascade="all, delete-orphan")
@@ -86,6 +109,16 @@ class Profile(db.Model):
     bio = db.Column(db.Text, nullable=True)
     photo = db.Column(db.String(255), nullable=True)
     slug = db.Column(db.String(100), unique=True, nullable=True)
+    # Slug en minúsculas para resolver las @menciones con un índice (se rellena en save_profile_slug_lower).
+    slug_lower = db.Column(db.String(100), index=True, nullable=True)
+    # Última modificación; los workers la usan para refrescar el índice de menciones (ver MentionIndex).
+    updated_at = db.Column(db.DateTime(timezone=True), index=True, nullable=True)
+
+@event.listens_for(Profile, 'before_insert')
+@event.listens_for(Profile, 'before_update')
+def save_profile_slug_lower(mapper, connection, profile):
+    profile.slug_lower = profile.slug.lower() if profile.slug else None
+    profile.updated_at = datetime.now(timezone.utc)
 
 class Section(db.Model):
     __tablename__ = 'sections'
@@ -101,6 +134,8 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    # HTML ya escapado, con menciones y enlaces, generado al escribir (ver render_content_html y render-content-html).
+    content_html = db.Column(db.Text, nullable=True)
     image_filename = db.Column(db.String(255), nullable=True)
     timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     section_id = db.Column(db.Integer, db.ForeignKey('sections.id', ondelete='SET NULL'), nullable=True)
@@ -109,9 +144,28 @@ class Post(db.Model):
     preview_description = db.Column(db.Text, nullable=True)
     preview_image_url = db.Column(db.Text, nullable=True)
     is_visible = db.Column(db.Boolean, default=True, nullable=False)
+    # Contadores desnormalizados; se actualizan en la misma transacción que la escritura (ver rebuild-counters).
+    reaction_count = db.Column(db.Integer, default=0, nullable=False)
+    like_count = db.Column(db.Integer, default=0, nullable=False)
+    love_count = db.Column(db.Integer, default=0, nullable=False)
+    haha_count = db.Column(db.Integer, default=0, nullable=False)
+    wow_count = db.Column(db.Integer, default=0, nullable=False)
+    sad_count = db.Column(db.Integer, default=0, nullable=False)
+    angry_count = db.Column(db.Integer, default=0, nullable=False)
+    comment_count = db.Column(db.Integer, default=0, nullable=False)
+    share_count = db.Column(db.Integer, default=0, nullable=False)
+    # Puntuación del modo 'top'; la recalcula periódicamente el comando compute-hot-scores.
+    hot_score = db.Column(db.Float, default=0, nullable=False)
     comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade="all, delete-orphan")
     reactions = db.relationship('PostReaction', backref='post', lazy='dynamic', cascade="all, delete-orphan")
     shared = db.relationship('SharedPost', foreign_keys='SharedPost.original_post_id', backref='original_post', lazy='dynamic', cascade="all, delete-orphan")
+    # Índices para la paginación por cursor (timestamp, id) del feed general y por sección.
+    __table_args__ = (
+        db.Index('ix_posts_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_posts_section_timestamp_id', 'section_id', 'timestamp', 'id'),
+        db.Index('ix_posts_hot_score_id', 'hot_score', 'id'),
+        db.Index('ix_posts_section_hot_score_id', 'section_id', 'hot_score', 'id'),
+    )
 
 class Comment(db.Model):
     __tablename__ = 'comments'
@@ -119,11 +173,18 @@ class Comment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text, nullable=True)
     parent_comment_id = db.Column(db.Integer, db.ForeignKey('comments.id', ondelete='CASCADE'), nullable=True)
     timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     is_visible = db.Column(db.Boolean, default=True, nullable=False)
+    reaction_count = db.Column(db.Integer, default=0, nullable=False)
+    reply_count = db.Column(db.Integer, default=0, nullable=False)
     replies = db.relationship('Comment', backref=db.backref('parent', remote_side=[id]), lazy='dynamic', cascade="all, delete-orphan")
     reactions = db.relationship('CommentReaction', backref='comment', lazy='dynamic', cascade="all, delete-orphan")
+    __table_args__ = (
+        db.Index('ix_comments_parent_timestamp_id', 'parent_comment_id', 'timestamp', 'id'),
+        db.Index('ix_comments_post_parent_timestamp_id', 'post_id', 'parent_comment_id', 'timestamp', 'id'),
+    )
 
 class PostReaction(db.Model):
     __tablename__ = 'post_reactions'
@@ -149,8 +210,12 @@ class SharedPost(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     original_post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
     quote_content = db.Column(db.Text, nullable=True)
+    quote_content_html = db.Column(db.Text, nullable=True)  # Como Post.content_html, generado al compartir
     timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
-    __table_args__ = (db.UniqueConstraint('user_id', 'original_post_id'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'original_post_id'),
+        db.Index('ix_shared_posts_timestamp_id', 'timestamp', 'id'),
+    )
 
 class BlockedUser(db.Model):
     __tablename__ = 'blocked_users'
@@ -158,7 +223,10 @@ class BlockedUser(db.Model):
     blocker_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     blocked_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
-    __table_args__ = (db.UniqueConstraint('blocker_user_id', 'blocked_user_id'),)
+    __table_args__ = (
+        db.UniqueConstraint('blocker_user_id', 'blocked_user_id'),
+        db.Index('ix_blocked_users_blocked_user_id', 'blocked_user_id'),
+    )
 
 class Contact(db.Model):
     __tablename__ = 'contactos'
@@ -177,21 +245,64 @@ class Notification(db.Model):
     referencia_id = db.Column(db.Integer, nullable=True)
     leida = db.Column(db.Boolean, default=False, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Notificaciones agrupadas: cuántos usuarios distintos han generado el evento y los últimos de ellos (IDs separados por comas).
+    actor_count = db.Column(db.Integer, default=1, nullable=False)
+    actor_ids = db.Column(db.Text, nullable=True)
+    # Índice para paginar por cursor: primero las no leídas y, dentro de cada grupo, las más recientes.
+    __table_args__ = (
+        db.Index('ix_notificaciones_user_leida_timestamp_id', 'user_id', 'leida', 'timestamp', 'id'),
+        db.Index('ix_notificaciones_leida_timestamp', 'leida', 'timestamp'),
+    )
+
+class NotificationActor(db.Model):
+    """Actores de una notificación agrupada que ya no caben en `actor_ids`; evita contarlos otra vez si repiten."""
+    __tablename__ = 'notification_actors'
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey('notificaciones.id', ondelete='CASCADE'), nullable=False)
+    actor_id = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint('notification_id', 'actor_id'),)
+
+class NotificationArchive(db.Model):
+    """Notificaciones leídas antiguas que el comando prune-notifications saca de la tabla principal."""
+    __tablename__ = 'notificaciones_archivo'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    mensaje = db.Column(db.Text, nullable=False)
+    tipo = db.Column(db.String(50), nullable=True)
+    referencia_id = db.Column(db.Integer, nullable=True)
+    timestamp = db.Column(db.DateTime(timezone=True))
+    archived_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
 class Conversation(db.Model):
     __tablename__ = 'conversations'
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # Clave canónica de las conversaciones directas (ids de los dos usuarios, menor primero); ver get_or_create_direct_conversation.
+    min_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=True)
+    max_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=True)
     participants = db.relationship('ConversationParticipant', backref='conversation', lazy='dynamic', cascade="all, delete-orphan")
     messages = db.relationship('Message', backref='conversation', lazy='dynamic', cascade="all, delete-orphan")
+    __table_args__ = (
+        db.UniqueConstraint('min_user_id', 'max_user_id', name='uq_conversations_direct_pair'),
+    )
 
 class ConversationParticipant(db.Model):
     __tablename__ = 'conversation_participants'
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id', ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
-    __table_args__ = (db.UniqueConstraint('conversation_id', 'user_id'),)
+    # Resumen para la bandeja de entrada; se mantiene en cada envío y lectura (ver rebuild-conversation-summaries).
+    last_message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='SET NULL'), nullable=True)
+    last_message_preview = db.Column(db.String(200), nullable=True)
+    last_message_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    # Cursor de lectura: los mensajes del otro participante con id mayor están sin leer.
+    last_read_message_id = db.Column(db.Integer, nullable=True)
+    __table_args__ = (
+        db.UniqueConstraint('conversation_id', 'user_id'),
+        db.Index('ix_conversation_participants_user_last_message_at', 'user_id', 'last_message_at', 'id'),
+    )
 
 class Message(db.Model):
     __tablename__ = 'messages'
@@ -200,8 +311,69 @@ class Message(db.Model):
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     body = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Obsoleto: el estado de lectura es ConversationParticipant.last_read_message_id (ver migrate-read-cursors).
     is_read = db.Column(db.Boolean, default=False, nullable=False)
+    __table_args__ = (
+        db.Index('ix_messages_conversation_timestamp_id', 'conversation_id', 'timestamp', 'id'),
+        db.Index('ix_messages_conversation_id_id', 'conversation_id', 'id'),
+    )
     
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    item_type = db.Column(db.String(20), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    activity_timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'item_type', 'item_id'),
+        db.Index('ix_timeline_entries_user_timestamp', 'user_id', 'activity_timestamp', 'item_id'),
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+    )
+
+class FeedMarker(db.Model):
+    __tablename__ = 'feed_markers'
+    scope = db.Column(db.String(120), primary_key=True)
+    latest_post_id = db.Column(db.Integer, nullable=True)
+    latest_timestamp = db.Column(db.DateTime(timezone=True), nullable=True)
+    sequence = db.Column(db.Integer, default=0, nullable=False)
+
+class Hashtag(db.Model):
+    __tablename__ = 'hashtags'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)  # En minúsculas, sin '#'
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+class PostHashtag(db.Model):
+    """Publicación o cita que usa un hashtag; `post_id` es la publicación original (para visibilidad)."""
+    __tablename__ = 'post_hashtags'
+    id = db.Column(db.Integer, primary_key=True)
+    hashtag_id = db.Column(db.Integer, db.ForeignKey('hashtags.id', ondelete='CASCADE'), nullable=False)
+    item_type = db.Column(db.String(20), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    activity_timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('hashtag_id', 'item_type', 'item_id'),
+        db.Index('ix_post_hashtags_hashtag_timestamp_item', 'hashtag_id', 'activity_timestamp', 'item_id'),
+        db.Index('ix_post_hashtags_item', 'item_type', 'item_id'),
+    )
+
+class HashtagBucket(db.Model):
+    """Usos de un hashtag por franja de HASHTAG_BUCKET; las tendencias suman las franjas de la ventana."""
+    __tablename__ = 'hashtag_buckets'
+    id = db.Column(db.Integer, primary_key=True)
+    hashtag_id = db.Column(db.Integer, db.ForeignKey('hashtags.id', ondelete='CASCADE'), nullable=False)
+    bucket_start = db.Column(db.DateTime(timezone=True), nullable=False)
+    count = db.Column(db.Integer, default=0, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('hashtag_id', 'bucket_start'),
+        db.Index('ix_hashtag_buckets_bucket_hashtag', 'bucket_start', 'hashtag_id'),
+    )
+
 class ActionLog(db.Model):
     __tablename__ = 'action_logs'
     id = db.Column(db.Integer, primary_key=True)
@@ -240,6 +412,34 @@ class Appeal(db.Model):
     
 # --- CONSTANTES Y CONFIGURACIÓN ---
 POSTS_PER_PAGE = 10
+REACTION_TYPES = ['like', 'love', 'haha', 'wow', 'sad', 'angry']
+COMMENTS_PER_PAGE = 20
+NOTIFICATIONS_PER_PAGE = 30
+SEARCH_RESULTS_PER_PAGE = 20
+MESSAGES_PER_PAGE = 50
+NOTIFICATION_AGGREGATE_WINDOW = timedelta(hours=24)
+NOTIFICATION_AGGREGATE_MAX_ACTORS = 20
+FEED_COMMENTS_PREVIEW = 5
+COMMENT_TREE_MAX_DEPTH = 6
+COMMENT_TREE_MAX_NODES = 300
+COMMENT_REPLIES_PER_PAGE = 10
+FEED_ORDERS = ('recientes', 'top')
+HOT_SCORE_GRAVITY = 1.8
+HOT_SCORE_WINDOW_DAYS = 7
+TIMELINE_FANOUT_MAX_CONTACTS = 1000
+TIMELINE_BACKFILL_ITEMS = 50
+FEED_MARKER_CACHE_SECONDS = 5
+HASHTAGS_PER_ITEM_MAX = 10
+HASHTAG_BUCKET = timedelta(hours=1)
+TRENDING_WINDOW = timedelta(hours=24)
+TRENDING_LIMIT = 10
+TRENDING_CACHE_SECONDS = 60
+BLOCK_CACHE_SECONDS = 60
+BLOCK_CACHE_MAX_USERS = 10000
+CONTACT_CACHE_SECONDS = 60
+MENTION_INDEX_REFRESH_SECONDS = 30
+MENTION_INDEX_REBUILD_SECONDS = 3600
+MENTION_SUGGESTIONS_LIMIT = 10
 UPLOAD_FOLDER = 'static/uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
@@ -306,18 +506,281 @@ if app.jinja_env:
     app.jinja_env.globals['format_timedelta'] = format_timedelta
     app.jinja_env.globals['format_number'] = format_number
 
+# --- EVENTOS EN TIEMPO REAL (SSE) ---
+
+EVENT_CHANNEL = 'piverse_events'
+SSE_KEEPALIVE_SECONDS = 15
+SSE_QUEUE_SIZE = 100
+# Postgres rechaza payloads de NOTIFY de 8000 bytes o más; se deja margen. Los eventos llevan ids y textos cortos.
+EVENT_PAYLOAD_MAX_BYTES = 7000
+# Canal interno (sin conexiones SSE) por el que los workers se avisan de cachés por proceso que han cambiado.
+CACHE_EVENT_CHANNEL = 'cache'
+
+class InProcessBroker:
+    """
+    Broker en memoria para desarrollo local (SQLite, un solo worker): reparte los eventos entre las
+    conexiones SSE del propio proceso suscritas a cada canal (el id de un usuario o conversation_channel()). Los eventos se retienen en la sesión y solo se entregan si la
+    transacción hace commit, igual que NOTIFY en Postgres.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._handlers = {}
+        event.listen(OrmSession, 'after_commit', self._deliver_pending)
+        event.listen(OrmSession, 'after_soft_rollback', self._discard_pending)
+
+    def publish(self, channel, event_name, data):
+        self.publish_many([(channel, event_name, data)])
+
+    def publish_many(self, events):
+        db.session.connection()  # Asegura una transacción abierta para que su commit/rollback decida la entrega.
+        db.session.info.setdefault('pending_events', []).extend(
+            {'channel': channel, 'event': event_name, 'data': data} for channel, event_name, data in events
+        )
+
+    def _deliver_pending(self, orm_session):
+        for message in orm_session.info.pop('pending_events', []):
+            self._deliver(message)
+
+    def _discard_pending(self, orm_session, previous_transaction):
+        # Un rollback de un SAVEPOINT (begin_nested) no descarta los eventos de la transacción principal.
+        if previous_transaction is None or not previous_transaction.nested:
+            orm_session.info.pop('pending_events', None)
+
+    def add_handler(self, channel, handler):
+        """Llama a `handler(event_name, data)` en este worker con cada evento del canal (p. ej. CACHE_EVENT_CHANNEL)."""
+        self._handlers[channel] = handler
+
+    def ensure_listening(self):
+        pass  # En memoria los eventos del propio proceso ya se entregan al hacer commit.
+
+    def _deliver(self, message):
+        handler = self._handlers.get(message['channel'])
+        if handler:
+            try:
+                handler(message['event'], message['data'])
+            except Exception as e:
+                print(f"!!! ERROR al procesar el evento '{message['event']}' del canal {message['channel']}: {e}")
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.get(message['channel'], ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(message)
+            except queue.Full:
+                pass  # Cliente demasiado lento: se pierde el evento y se resincroniza al reconectar.
+
+    def subscribe(self, channel):
+        events = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(events)
+        return events
+
+    def unsubscribe(self, channel, events):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers:
+                subscribers.discard(events)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+class PostgresBroker(InProcessBroker):
+    """
+    Broker para producción: publish hace pg_notify dentro de la transacción actual, y cada worker
+    mantiene un hilo con una conexión dedicada en LISTEN que entrega los eventos a sus conexiones SSE.
+    Así un evento llega a cualquier worker sin que cada conexión consulte la base de datos.
+    """
+    def __init__(self, dsn):
+        super().__init__()
+        self.dsn = dsn
+        self._listener = None
+        self._listener_pid = None
+
+    def publish_many(self, events):
+        payloads = [json.dumps({'channel': channel, 'event': event_name, 'data': data}) for channel, event_name, data in events]
+        # En un SAVEPOINT: si pg_notify falla solo se deshace el savepoint, no la transacción de la petición.
+        with db.session.begin_nested():
+            db.session.execute(
+                text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+                {'channel': EVENT_CHANNEL, 'payloads': payloads}
+            )
+
+    def subscribe(self, channel):
+        self._ensure_listener()
+        return super().subscribe(channel)
+
+    def ensure_listening(self):
+        # Cada worker escucha aunque no tenga conexiones SSE, para recibir las invalidaciones de caché.
+        self._ensure_listener()
+
+    def _ensure_listener(self):
+        # El hilo se arranca en el propio worker (después del fork de gunicorn).
+        with self._lock:
+            if self._listener and self._listener.is_alive() and self._listener_pid == os.getpid():
+                return
+            self._listener = threading.Thread(target=self._listen, name='pg-event-listener', daemon=True)
+            self._listener_pid = os.getpid()
+            self._listener.start()
+
+    def _listen(self):
+        import psycopg2
+        from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+        while True:
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {EVENT_CHANNEL};")
+                while True:
+                    if select.select([conn], [], [], SSE_KEEPALIVE_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._deliver(json.loads(conn.notifies.pop(0).payload))
+            except Exception as e:
+                print(f"!!! ERROR en el listener de eventos de Postgres: {e}")
+                time.sleep(5)
+
+if DATABASE_URL.startswith('postgresql'):
+    event_broker = PostgresBroker(DATABASE_URL)
+else:
+    event_broker = InProcessBroker()
+
+def conversation_channel(conversation_id):
+    """Canal del broker de una conversación abierta (los canales de usuario son su id)."""
+    return f"conversacion:{conversation_id}"
+
+def publish_event(channel, event_name, data):
+    """Publica un evento para las conexiones SSE de un canal (un usuario o una conversación); se entrega al hacer commit. No hace commit."""
+    publish_events([(channel, event_name, data)])
+
+def publish_events(events):
+    """Publica en una sola operación una lista de eventos (canal, nombre, datos). No hace commit."""
+    sized_events = []
+    for channel, event_name, data in events:
+        if len(json.dumps({'channel': channel, 'event': event_name, 'data': data})) > EVENT_PAYLOAD_MAX_BYTES:
+            # El cliente se resincroniza al recargar o reconectar; un evento demasiado grande no debe romper la transacción.
+            print(f"!!! Evento '{event_name}' para {channel} descartado: supera {EVENT_PAYLOAD_MAX_BYTES} bytes.")
+            continue
+        sized_events.append((channel, event_name, data))
+    if not sized_events:
+        return
+    try:
+        event_broker.publish_many(sized_events)
+    except Exception as e:
+        print(f"!!! ERROR al publicar {len(sized_events)} eventos: {e}")
+
 # --- FUNCIONES AUXILIARES (MODIFICADAS PARA USAR SQLAlchemy) ---
 
 def create_system_notification(user_id, message, notif_type='system', reference_id=None):
     try:
         notif = Notification(user_id=user_id, mensaje=message, tipo=notif_type, referencia_id=reference_id)
         db.session.add(notif)
+        increment_counter(User, user_id, User.unread_notifications_count)
+        publish_event(user_id, 'notification', {'mensaje': message, 'tipo': notif_type, 'referencia_id': reference_id})
     except Exception as e:
         # No hacemos commit aquí, se hará en la ruta que llama a esta función.
         # Pero sí hacemos rollback en caso de error para no dejar la sesión en un estado inconsistente.
         db.session.rollback()
         print(f"!!! ERROR al preparar la notificación del sistema: {e}")
 
+def create_system_notifications(user_ids, message, notif_type='system', reference_id=None, actor_id=None):
+    """
+    Versión en bloque de create_system_notification para varios destinatarios con el mismo mensaje:
+    un INSERT, un UPDATE de contadores y una publicación de eventos. No hace commit.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    db.session.execute(db.insert(Notification), [
+        {'user_id': user_id, 'mensaje': message, 'tipo': notif_type, 'referencia_id': reference_id,
+         'actor_ids': str(actor_id) if actor_id else None}
+        for user_id in user_ids
+    ])
+    db.session.query(User).filter(User.id.in_(user_ids)).update(
+        {User.unread_notifications_count: User.unread_notifications_count + 1}, synchronize_session=False
+    )
+    publish_events([
+        (user_id, 'notification', {'mensaje': message, 'tipo': notif_type, 'referencia_id': reference_id})
+        for user_id in user_ids
+    ])
+
+def aggregated_notification_message(notif_type, actor_link_html, reference_url, others):
+    """Texto de una notificación agrupada: el último actor y cuántos más."""
+    post_link_html = f'<a href="{reference_url}">{_("publicación")}</a>'
+    variables = {'actor_link': actor_link_html, 'post_link': post_link_html}
+    if notif_type == 'nuevo_comentario':
+        return ngettext('%(actor_link)s y %(num)d persona más han comentado en tu %(post_link)s.',
+                        '%(actor_link)s y %(num)d personas más han comentado en tu %(post_link)s.', others, **variables)
+    if notif_type == 'respuesta_comentario':
+        return ngettext('%(actor_link)s y %(num)d persona más han respondido a tu comentario en una %(post_link)s.',
+                        '%(actor_link)s y %(num)d personas más han respondido a tu comentario en una %(post_link)s.', others, **variables)
+    if notif_type == 'share_post':
+        return ngettext('%(actor_link)s y %(num)d persona más han compartido tu %(post_link)s.',
+                        '%(actor_link)s y %(num)d personas más han compartido tu %(post_link)s.', others, **variables)
+    if notif_type == 'share_post_with_quote':
+        return ngettext('%(actor_link)s y %(num)d persona más han citado tu %(post_link)s.',
+                        '%(actor_link)s y %(num)d personas más han citado tu %(post_link)s.', others, **variables)
+    if notif_type == 'mencion_comentario':
+        return ngettext('%(actor_link)s y %(num)d persona más te han mencionado en comentarios de una %(post_link)s.',
+                        '%(actor_link)s y %(num)d personas más te han mencionado en comentarios de una %(post_link)s.', others, **variables)
+    return ngettext('%(actor_link)s y %(num)d persona más te han mencionado en una %(post_link)s.',
+                    '%(actor_link)s y %(num)d personas más te han mencionado en una %(post_link)s.', others, **variables)
+
+def create_aggregated_notifications(user_ids, notif_type, reference_id, actor_id, actor_link_html, reference_url, message):
+    """
+    Notifica un evento a varios usuarios agrupándolo por (destinatario, tipo, referencia): si el destinatario
+    tiene una notificación no leída con esa clave de las últimas NOTIFICATION_AGGREGATE_WINDOW, se actualiza
+    con el número de actores y el último de ellos en lugar de insertar otra fila. Un actor solo se cuenta una vez:
+    los que salen de los NOTIFICATION_AGGREGATE_MAX_ACTORS recientes se guardan en NotificationActor. No hace commit.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    now = datetime.now(timezone.utc)
+    existing = {}
+    for notif in db.session.query(Notification).filter(
+        Notification.user_id.in_(user_ids), Notification.leida == False, Notification.tipo == notif_type,
+        Notification.referencia_id == reference_id, Notification.timestamp >= now - NOTIFICATION_AGGREGATE_WINDOW
+    ).order_by(Notification.timestamp.asc()).with_for_update():
+        existing[notif.user_id] = notif
+
+    counted_before = set()
+    if existing:
+        counted_before = {row[0] for row in db.session.query(NotificationActor.notification_id).filter(
+            NotificationActor.notification_id.in_([notif.id for notif in existing.values()]), NotificationActor.actor_id == actor_id)}
+
+    events = []
+    dropped_actors = []
+    for notif in existing.values():
+        recent_actors = [int(a) for a in (notif.actor_ids or '').split(',') if a]
+        if actor_id not in recent_actors and notif.id not in counted_before:
+            notif.actor_count += 1
+        recent_actors = [actor_id] + [a for a in recent_actors if a != actor_id]
+        dropped_actors.extend((notif.id, a) for a in recent_actors[NOTIFICATION_AGGREGATE_MAX_ACTORS:])
+        recent_actors = recent_actors[:NOTIFICATION_AGGREGATE_MAX_ACTORS]
+        notif.actor_ids = ','.join(str(a) for a in recent_actors)
+        notif.timestamp = now
+        if notif.actor_count > 1:
+            notif.mensaje = aggregated_notification_message(notif_type, actor_link_html, reference_url, notif.actor_count - 1)
+        else:
+            notif.mensaje = message
+        # La fila ya contaba como no leída: el contador no cambia y el navegador no debe sumarla otra vez.
+        events.append((notif.user_id, 'notification', {'mensaje': notif.mensaje, 'tipo': notif_type, 'referencia_id': reference_id, 'agregada': True}))
+    if dropped_actors:
+        # Un actor que volvió a la lista de recientes ya tiene su fila: no se inserta dos veces.
+        already_stored = set(db.session.query(NotificationActor.notification_id, NotificationActor.actor_id).filter(
+            NotificationActor.notification_id.in_({notification_id for notification_id, _actor in dropped_actors}),
+            NotificationActor.actor_id.in_({actor for _notification_id, actor in dropped_actors})
+        ))
+        new_rows = [{'notification_id': notification_id, 'actor_id': actor} for notification_id, actor in dropped_actors
+                    if (notification_id, actor) not in already_stored]
+        if new_rows:
+            db.session.execute(db.insert(NotificationActor), new_rows)
+    publish_events(events)
+
+    create_system_notifications([user_id for user_id in user_ids if user_id not in existing], message, notif_type, reference_id, actor_id=actor_id)
+
 def login_required_api(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -336,17 +799,247 @@ def generar_slug(nombre):
     slug = re.sub(r'[^\w_]', '', slug)
     return slug
 
+class LruTtlCache:
+    """
+    Caché por proceso acotada: al llenarse descarta la entrada usada hace más tiempo (en vez de vaciarse entera
+    y forzar que todos los usuarios se recarguen a la vez) y cada entrada caduca a los `ttl_seconds`. Es segura
+    entre hilos, porque el hilo del broker la invalida mientras las peticiones la leen.
+    """
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if time.monotonic() - entry[1] >= self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+# Caché por proceso: user_id -> IDs bloqueados por el usuario o que lo han bloqueado.
+# block_user/unblock_user la invalidan para ambos usuarios en todos los workers (publish_cache_invalidation);
+# BLOCK_CACHE_SECONDS solo acota el caso de que se pierda el aviso. Los filtros de las queries y el envío de
+# mensajes no dependen de ella (not_blocked_clause, is_blocked_between).
+_block_set_cache = LruTtlCache(BLOCK_CACHE_MAX_USERS, BLOCK_CACHE_SECONDS)
+
 def get_blocked_and_blocking_ids(user_id):
     if not user_id:
         return set()
-    
-    blocked_by_me_q = db.session.query(BlockedUser.blocked_user_id).filter_by(blocker_user_id=user_id)
-    blocked_me_q = db.session.query(BlockedUser.blocker_user_id).filter_by(blocked_user_id=user_id)
-    
-    excluded_ids = {item[0] for item in blocked_by_me_q.all()}
-    excluded_ids.update({item[0] for item in blocked_me_q.all()})
-    
-    return excluded_ids
+
+    cached = _block_set_cache.get(user_id)
+    if cached is not None:
+        return set(cached)
+
+    blocked_by_me_q = db.session.query(BlockedUser.blocked_user_id).filter(BlockedUser.blocker_user_id == user_id)
+    blocked_me_q = db.session.query(BlockedUser.blocker_user_id).filter(BlockedUser.blocked_user_id == user_id)
+    excluded_ids = frozenset(item[0] for item in blocked_by_me_q.union(blocked_me_q).all())
+    _block_set_cache.set(user_id, excluded_ids)
+    return set(excluded_ids)
+
+def invalidate_block_cache(*user_ids):
+    for user_id in user_ids:
+        _block_set_cache.pop(user_id)
+
+# Caché por proceso: user_id -> ids de sus contactos aceptados. Igual que la de bloqueos,
+# aceptar_solicitud, eliminar_contacto y block_user la invalidan para ambos usuarios.
+_contact_set_cache = LruTtlCache(BLOCK_CACHE_MAX_USERS, CONTACT_CACHE_SECONDS)
+
+def get_contact_ids(user_id):
+    if not user_id:
+        return set()
+
+    cached = _contact_set_cache.get(user_id)
+    if cached is not None:
+        return set(cached)
+
+    contact_ids = frozenset(item[0] for item in accepted_contact_ids_select(user_id).all())
+    _contact_set_cache.set(user_id, contact_ids)
+    return set(contact_ids)
+
+def invalidate_contact_cache(*user_ids):
+    for user_id in user_ids:
+        _contact_set_cache.pop(user_id)
+
+def is_blocked_between(user_id, other_user_id):
+    """Comprueba sin caché si hay un bloqueo, en cualquier sentido, entre dos usuarios (para mensajes y avisos directos)."""
+    return db.session.query(db.exists().where(or_(
+        and_(BlockedUser.blocker_user_id == user_id, BlockedUser.blocked_user_id == other_user_id),
+        and_(BlockedUser.blocker_user_id == other_user_id, BlockedUser.blocked_user_id == user_id)
+    ))).scalar()
+
+def publish_cache_invalidation(cache_name, *user_ids):
+    """Avisa a todos los workers (también a este) de que descarten la caché `cache_name` de esos usuarios al hacer commit. No hace commit."""
+    publish_event(CACHE_EVENT_CHANNEL, 'invalidate', {'cache': cache_name, 'user_ids': list(user_ids)})
+
+def _handle_cache_event(event_name, data):
+    if event_name != 'invalidate':
+        return
+    if data.get('cache') == 'block':
+        invalidate_block_cache(*data.get('user_ids', ()))
+    elif data.get('cache') == 'contact':
+        invalidate_contact_cache(*data.get('user_ids', ()))
+
+event_broker.add_handler(CACHE_EVENT_CHANNEL, _handle_cache_event)
+
+@app.before_request
+def ensure_event_listener():
+    event_broker.ensure_listening()
+
+def not_blocked_clause(user_id, user_column):
+    """
+    Condición para excluir dentro de la query a los usuarios con un bloqueo, en cualquier sentido,
+    respecto a `user_id`: un NOT EXISTS correlacionado con `user_column`, que no crece con la lista
+    de bloqueos. No consulta la caché, así que un bloqueo recién hecho se aplica en todos los workers.
+    """
+    return ~db.exists().where(or_(
+        and_(BlockedUser.blocker_user_id == user_id, BlockedUser.blocked_user_id == user_column),
+        and_(BlockedUser.blocked_user_id == user_id, BlockedUser.blocker_user_id == user_column)
+    ))
+
+# --- AUTOCOMPLETADO DE MENCIONES (ÍNDICE EN MEMORIA) ---
+
+class MentionIndex:
+    """
+    Índice de prefijos por worker para el autocompletado de @menciones: una lista ordenada de claves
+    (slug, nombre de usuario y cada palabra del nombre, en minúsculas) que se recorre con bisect.
+    Se carga entero al primer uso y cada MENTION_INDEX_REBUILD_SECONDS (para retirar perfiles borrados);
+    entre medias solo se leen los perfiles con updated_at reciente, como mucho cada
+    MENTION_INDEX_REFRESH_SECONDS o en cuanto este worker guarda un perfil.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # [(clave, user_id)] ordenada
+        self._profiles = {}  # user_id -> (username, slug, photo, claves)
+        self._built_at = None
+        self._refreshed_at = None
+        self._last_seen = None
+        self._stale = False
+
+    @staticmethod
+    def _profile_keys(username, slug):
+        keys = {slug.casefold(), username.casefold()}
+        keys.update(word for word in username.casefold().split())
+        return tuple(sorted(keys))
+
+    def _remove(self, user_id):
+        entry = self._profiles.pop(user_id, None)
+        if not entry:
+            return
+        for key in entry[3]:
+            position = bisect.bisect_left(self._keys, (key, user_id))
+            if position < len(self._keys) and self._keys[position] == (key, user_id):
+                del self._keys[position]
+
+    def _upsert(self, user_id, username, slug, photo):
+        self._remove(user_id)
+        if not username or not slug:
+            return
+        keys = self._profile_keys(username, slug)
+        self._profiles[user_id] = (username, slug, photo, keys)
+        for key in keys:
+            bisect.insort(self._keys, (key, user_id))
+
+    def mark_stale(self, rebuild=False):
+        self._stale = True
+        if rebuild:
+            self._built_at = None
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._built_at is None or now - self._built_at > MENTION_INDEX_REBUILD_SECONDS:
+            rows = db.session.query(Profile.user_id, Profile.username, Profile.slug, Profile.photo, Profile.updated_at).filter(
+                Profile.username != None, Profile.slug != None
+            ).all()
+            with self._lock:
+                self._profiles = {}
+                self._keys = []
+                for row in rows:
+                    keys = self._profile_keys(row.username, row.slug)
+                    self._profiles[row.user_id] = (row.username, row.slug, row.photo, keys)
+                    self._keys.extend((key, row.user_id) for key in keys)
+                self._keys.sort()
+                self._built_at = self._refreshed_at = now
+                self._last_seen = max((row.updated_at for row in rows if row.updated_at), default=None)
+                self._stale = False
+            return
+
+        if not self._stale and now - self._refreshed_at < MENTION_INDEX_REFRESH_SECONDS:
+            return
+        changes_q = db.session.query(Profile.user_id, Profile.username, Profile.slug, Profile.photo, Profile.updated_at)
+        if self._last_seen:
+            # Se solapa una ventana de refresco para no perder transacciones que hicieron commit tarde.
+            changes_q = changes_q.filter(Profile.updated_at >= self._last_seen - timedelta(seconds=MENTION_INDEX_REFRESH_SECONDS))
+        else:
+            changes_q = changes_q.filter(Profile.updated_at != None)
+        rows = changes_q.all()
+        with self._lock:
+            for row in rows:
+                self._upsert(row.user_id, row.username, row.slug, row.photo)
+                if not self._last_seen or parse_timestamp(row.updated_at) > parse_timestamp(self._last_seen):
+                    self._last_seen = row.updated_at
+            self._refreshed_at = now
+            self._stale = False
+
+    def suggest(self, term, viewer_id, limit=MENTION_SUGGESTIONS_LIMIT):
+        """Perfiles cuyo slug o nombre empieza por `term`: primero los contactos del usuario, sin bloqueados."""
+        prefix = term.casefold().lstrip('@')
+        if not prefix:
+            return []
+        self._refresh()
+        excluded_ids = get_blocked_and_blocking_ids(viewer_id)
+        excluded_ids.add(viewer_id)
+        contact_ids = get_contact_ids(viewer_id) - excluded_ids
+
+        with self._lock:
+            found = sorted(
+                (self._profiles[user_id] for user_id in contact_ids
+                 if user_id in self._profiles and any(key.startswith(prefix) for key in self._profiles[user_id][3])),
+                key=lambda entry: entry[0].casefold()
+            )[:limit]
+            seen = {entry[1] for entry in found}
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while len(found) < limit and position < len(self._keys):
+                key, user_id = self._keys[position]
+                position += 1
+                if not key.startswith(prefix):
+                    break
+                entry = self._profiles[user_id]
+                if user_id in excluded_ids or entry[1] in seen:
+                    continue
+                seen.add(entry[1])
+                found.append(entry)
+        return [{'username': username, 'slug': slug, 'photo': photo} for username, slug, photo, _keys in found]
+
+mention_index = MentionIndex()
+
+@event.listens_for(Profile, 'after_insert')
+@event.listens_for(Profile, 'after_update')
+def mark_mention_index_stale(mapper, connection, profile):
+    mention_index.mark_stale()
+
+@event.listens_for(Profile, 'after_delete')
+def mark_mention_index_for_rebuild(mapper, connection, profile):
+    mention_index.mark_stale(rebuild=True)
 
 def regenerar_slugs_si_faltan():
     with app.app_context():
@@ -374,51 +1067,72 @@ def regenerar_slugs_si_faltan():
                 db.session.rollback()
                 print("Error de integridad al regenerar slugs. Se revirtieron los cambios.")
 
+def get_current_user():
+    """
+    Usuario de la sesión (con su perfil), cargado una sola vez por petición y guardado en `g`.
+    Lo usan los decoradores de acceso, check_profile_completion y el procesador de contexto.
+    """
+    user_id = session.get('user_id')
+    if g.get('current_user_id', 0) != user_id:
+        g.current_user = db.session.query(User).options(joinedload(User.profile)).get(user_id) if user_id else None
+        g.current_user_id = user_id
+    return g.current_user
+
 def check_profile_completion(user_id):
     if user_id is None: 
         return False
-    profile = db.session.query(Profile).filter_by(user_id=user_id).first()
+    current_user = get_current_user()
+    if current_user and current_user.id == user_id:
+        profile = current_user.profile
+    else:
+        profile = db.session.query(Profile).filter_by(user_id=user_id).first()
     return bool(profile and profile.username and profile.username.strip() and profile.slug and profile.slug.strip())
 
 def procesar_menciones_y_notificar(texto, autor_id, id_referencia, tipo_contenido_str):
+    """
+    Notifica a los usuarios mencionados: resuelve todos los slugs con una consulta sobre slug_lower
+    e inserta las notificaciones en bloque. No hace commit; forma parte de la transacción de la ruta.
+    """
     if not texto:
         return
-    menciones_encontradas = set(re.findall(r'@([a-zA-Z0-9_]+)', texto, flags=re.IGNORECASE))
+    menciones_encontradas = {slug.lower() for slug in re.findall(r'@([a-zA-Z0-9_]+)', texto, flags=re.IGNORECASE)}
     if not menciones_encontradas:
         return
 
-    autor_perfil = db.session.query(Profile).filter_by(user_id=autor_id).first()
+    current_user = get_current_user()
+    if current_user and current_user.id == autor_id:
+        autor_perfil = current_user.profile
+    else:
+        autor_perfil = db.session.query(Profile).filter_by(user_id=autor_id).first()
     if not autor_perfil or not autor_perfil.slug:
         return
 
     excluded_ids = get_blocked_and_blocking_ids(autor_id)
-    autor_slug_enlace = autor_perfil.slug
+    mencionados_ids = [
+        user_id for (user_id,) in db.session.query(Profile.user_id).filter(Profile.slug_lower.in_(menciones_encontradas))
+        if user_id != autor_id and user_id not in excluded_ids
+    ]
+    if not mencionados_ids:
+        return
+
+    try:
+        enlace_post_url = url_for("ver_publicacion_individual", post_id=int(id_referencia))
+    except (ValueError, TypeError):
+        enlace_post_url = "#"
+    
     autor_nombre_visible = autor_perfil.username or _("Usuario")
+    autor_link_html = f'<a href="{url_for("ver_perfil", slug_perfil=autor_perfil.slug)}">@{autor_nombre_visible}</a>'
     
-    for slug_mencionado in menciones_encontradas:
-        mencionado = db.session.query(Profile).filter(Profile.slug.ilike(slug_mencionado)).first()
-        if mencionado and mencionado.user_id != autor_id and mencionado.user_id not in excluded_ids:
-            try:
-                enlace_post_url = url_for("ver_publicacion_individual", post_id=int(id_referencia))
-            except (ValueError, TypeError):
-                enlace_post_url = "#"
-            
-            autor_link_html = f'<a href="{url_for("ver_perfil", slug_perfil=autor_slug_enlace)}">@{autor_nombre_visible}</a>'
-            
-            if tipo_contenido_str == "publicación":
-                contenido_link_html = f'<a href="{enlace_post_url}">{_("publicación")}</a>'
-                mensaje = _('%(autor_link)s te mencionó en una %(contenido_link)s.') % {'autor_link': autor_link_html, 'contenido_link': contenido_link_html}
-            else: # comentario
-                contenido_link_html = f'<a href="{enlace_post_url}">{_("comentario")}</a>'
-                mensaje = _('%(autor_link)s te mencionó en un %(contenido_link)s.') % {'autor_link': autor_link_html, 'contenido_link': contenido_link_html}
-            
-            create_system_notification(mencionado.user_id, mensaje, 'mencion', id_referencia)
+    if tipo_contenido_str == "publicación":
+        contenido_link_html = f'<a href="{enlace_post_url}">{_("publicación")}</a>'
+        mensaje = _('%(autor_link)s te mencionó en una %(contenido_link)s.') % {'autor_link': autor_link_html, 'contenido_link': contenido_link_html}
+    else: # comentario
+        contenido_link_html = f'<a href="{enlace_post_url}">{_("comentario")}</a>'
+        mensaje = _('%(autor_link)s te mencionó en un %(contenido_link)s.') % {'autor_link': autor_link_html, 'contenido_link': contenido_link_html}
     
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"Error al guardar notificaciones de mención: {e}")
+    # Las menciones en la publicación y en sus comentarios se agrupan por separado (mismo id de publicación).
+    tipo_notif = 'mencion' if tipo_contenido_str == "publicación" else 'mencion_comentario'
+    create_aggregated_notifications(mencionados_ids, tipo_notif, id_referencia, autor_id, autor_link_html, enlace_post_url, mensaje)
 
 def procesar_menciones_para_mostrar(texto):
     if texto is None: 
@@ -450,9 +1164,1191 @@ def parse_timestamp(timestamp_str):
             return dt_obj.replace(tzinfo=timezone.utc)
         except (ValueError, TypeError):
             continue
-            
-    print(f"ADVERTENCIA: No se pudo parsear la cadena de timestamp: '{timestamp_str}' con los formatos probados.")
-    return None
+            
+    print(f"ADVERTENCIA: No se pudo parsear la cadena de timestamp: '{timestamp_str}' con los formatos probados.")
+    return None
+
+# --- CONTADORES DESNORMALIZADOS ---
+
+def reaction_count_column(reaction_type):
+    """Columna de Post que cuenta las reacciones de un tipo."""
+    return getattr(Post, f'{reaction_type}_count')
+
+def update_post_reaction_counters(post_id, old_type=None, new_type=None):
+    """Ajusta los contadores de reacciones de un post al crear, cambiar o quitar una reacción. No hace commit."""
+    values = {}
+    if old_type:
+        values[reaction_count_column(old_type)] = reaction_count_column(old_type) - 1
+    if new_type:
+        values[reaction_count_column(new_type)] = reaction_count_column(new_type) + 1
+    if bool(new_type) != bool(old_type):
+        values[Post.reaction_count] = Post.reaction_count + (1 if new_type else -1)
+    if values:
+        db.session.query(Post).filter(Post.id == post_id).update(values, synchronize_session=False)
+
+def increment_counter(model, row_id, column, delta=1):
+    """Suma `delta` a un contador con un UPDATE atómico. No hace commit."""
+    db.session.query(model).filter(model.id == row_id).update({column: column + delta}, synchronize_session=False)
+
+def compute_counters():
+    """Recalcula desde las tablas de origen los contadores de posts y comentarios: {(modelo, id): {columna: valor}}."""
+    expected = {}
+    for post_id, reaction_type, total in db.session.query(PostReaction.post_id, PostReaction.reaction_type, func.count(PostReaction.id)).group_by(PostReaction.post_id, PostReaction.reaction_type):
+        counters = expected.setdefault((Post, post_id), {})
+        if reaction_type in REACTION_TYPES:
+            counters[f'{reaction_type}_count'] = total
+        counters['reaction_count'] = counters.get('reaction_count', 0) + total
+    for post_id, total in db.session.query(Comment.post_id, func.count(Comment.id)).filter(Comment.is_visible == True).group_by(Comment.post_id):
+        expected.setdefault((Post, post_id), {})['comment_count'] = total
+    for post_id, total in db.session.query(SharedPost.original_post_id, func.count(SharedPost.id)).group_by(SharedPost.original_post_id):
+        expected.setdefault((Post, post_id), {})['share_count'] = total
+    for comment_id, total in db.session.query(CommentReaction.comment_id, func.count(CommentReaction.id)).group_by(CommentReaction.comment_id):
+        expected.setdefault((Comment, comment_id), {})['reaction_count'] = total
+    for comment_id, total in db.session.query(Comment.parent_comment_id, func.count(Comment.id)).filter(Comment.parent_comment_id != None, Comment.is_visible == True).group_by(Comment.parent_comment_id):
+        expected.setdefault((Comment, comment_id), {})['reply_count'] = total
+    return expected
+
+def compute_unread_counters(user_ids=None):
+    """
+    Recalcula desde las tablas de origen los contadores de no leídos: {user_id: {columna: valor}}.
+    Los mensajes de usuarios con un bloqueo en cualquier sentido no cuentan, igual que en la barra.
+    """
+    expected = {}
+    notifications_q = db.session.query(Notification.user_id, func.count(Notification.id)).filter(Notification.leida == False)
+    blocked = db.exists().where(or_(
+        and_(BlockedUser.blocker_user_id == ConversationParticipant.user_id, BlockedUser.blocked_user_id == Message.sender_id),
+        and_(BlockedUser.blocked_user_id == ConversationParticipant.user_id, BlockedUser.blocker_user_id == Message.sender_id)
+    ))
+    messages_q = db.session.query(ConversationParticipant.user_id, func.count(Message.id)).join(
+        Message, Message.conversation_id == ConversationParticipant.conversation_id
+    ).filter(Message.sender_id != ConversationParticipant.user_id, Message.id > func.coalesce(ConversationParticipant.last_read_message_id, 0), ~blocked)
+    if user_ids is not None:
+        notifications_q = notifications_q.filter(Notification.user_id.in_(user_ids))
+        messages_q = messages_q.filter(ConversationParticipant.user_id.in_(user_ids))
+    for user_id, total in notifications_q.group_by(Notification.user_id):
+        expected.setdefault(user_id, {})['unread_notifications_count'] = total
+    for user_id, total in messages_q.group_by(ConversationParticipant.user_id):
+        expected.setdefault(user_id, {})['unread_messages_count'] = total
+    return expected
+
+def refresh_unread_counters(*user_ids):
+    """Recalcula los contadores de no leídos de unos usuarios concretos (p. ej. tras un bloqueo). No hace commit."""
+    expected = compute_unread_counters(list(user_ids))
+    for user_id in user_ids:
+        wanted = expected.get(user_id, {})
+        db.session.query(User).filter(User.id == user_id).update({
+            User.unread_notifications_count: wanted.get('unread_notifications_count', 0),
+            User.unread_messages_count: wanted.get('unread_messages_count', 0)
+        }, synchronize_session=False)
+
+MESSAGE_PREVIEW_LENGTH = 200
+
+def message_preview(body):
+    """Recorta el cuerpo de un mensaje para el resumen de la bandeja de entrada."""
+    return body[:MESSAGE_PREVIEW_LENGTH]
+
+def compute_conversation_summaries():
+    """
+    Recalcula desde la tabla de mensajes el resumen de cada participante:
+    {participant_id: {'last_message_id', 'last_message_preview', 'last_message_at', 'unread_count'}}.
+    """
+    ranked = db.session.query(
+        Message.id, Message.conversation_id, Message.body, Message.timestamp,
+        func.row_number().over(partition_by=Message.conversation_id, order_by=(Message.timestamp.desc(), Message.id.desc())).label('rn')
+    ).subquery()
+    last_messages = {
+        row.conversation_id: row for row in db.session.query(ranked).filter(ranked.c.rn == 1)
+    }
+    unread = dict(db.session.query(ConversationParticipant.id, func.count(Message.id)).join(
+        Message, Message.conversation_id == ConversationParticipant.conversation_id
+    ).filter(Message.sender_id != ConversationParticipant.user_id, Message.id > func.coalesce(ConversationParticipant.last_read_message_id, 0)).group_by(ConversationParticipant.id))
+
+    expected = {}
+    for participant_id, conversation_id in db.session.query(ConversationParticipant.id, ConversationParticipant.conversation_id):
+        last = last_messages.get(conversation_id)
+        expected[participant_id] = {
+            'last_message_id': last.id if last else None,
+            'last_message_preview': message_preview(last.body) if last else None,
+            'last_message_at': last.timestamp if last else None,
+            'unread_count': unread.get(participant_id, 0)
+        }
+    return expected
+
+def unread_messages_count_select(participant_model=ConversationParticipant):
+    """Subconsulta correlacionada con los mensajes recibidos después del cursor de lectura del participante."""
+    return db.select(func.count(Message.id)).where(
+        Message.conversation_id == participant_model.conversation_id,
+        Message.sender_id != participant_model.user_id,
+        Message.id > func.coalesce(participant_model.last_read_message_id, 0)
+    ).scalar_subquery()
+
+def conversation_summary(participant):
+    """
+    Resumen de la bandeja de un participante calculado desde los mensajes, para las conversaciones anteriores al
+    resumen que aún no han recibido mensajes nuevos ni pasado por rebuild-conversation-summaries. No guarda nada.
+    """
+    last = Message.query.filter(Message.conversation_id == participant.conversation_id).order_by(
+        Message.timestamp.desc(), Message.id.desc()
+    ).first()
+    unread_count = db.session.query(unread_messages_count_select(ConversationParticipant)).select_from(
+        ConversationParticipant
+    ).filter(ConversationParticipant.id == participant.id).scalar() if last else 0
+    return {
+        'last_message_id': last.id if last else None,
+        'last_message_preview': message_preview(last.body) if last else None,
+        'last_message_at': last.timestamp if last else None,
+        'unread_count': unread_count or 0
+    }
+
+# --- MOTOR DEL FEED (PAGINACIÓN POR CURSOR) ---
+
+FEED_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_feed_cursor(activity_timestamp, item_id):
+    """Codifica la posición (timestamp, id) del último item servido como un cursor opaco."""
+    ts = parse_timestamp(activity_timestamp)
+    micros = (ts - FEED_CURSOR_EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{item_id}"
+
+def decode_feed_cursor(cursor):
+    """Devuelve (timestamp, id) a partir de un cursor, o None si no es válido."""
+    if not cursor:
+        return None
+    try:
+        micros_str, item_id_str = cursor.split('_', 1)
+        return FEED_CURSOR_EPOCH + timedelta(microseconds=int(micros_str)), int(item_id_str)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def _keyset_before(timestamp_col, id_col, cursor_pos):
+    """Condición 'estrictamente anterior al cursor' en orden (timestamp DESC, id DESC)."""
+    cursor_ts, cursor_id = cursor_pos
+    return or_(timestamp_col < cursor_ts, and_(timestamp_col == cursor_ts, id_col < cursor_id))
+
+def build_feed_query(viewer_id, section_id=None, cursor_pos=None, limit=POSTS_PER_PAGE, author_ids=None):
+    """
+    Construye la consulta del feed: publicaciones y compartidos unidos con UNION ALL,
+    ordenados por (timestamp, id) y filtrados por bloqueos y sección en la misma query.
+    Cada rama aplica el cursor y el límite por separado para que el coste de una página
+    no dependa de lo lejos que esté en el feed. `author_ids` restringe la actividad a
+    esos autores (lista o subconsulta).
+    """
+    posts_q = db.session.query(
+        Post.id.label("item_id"),
+        Post.timestamp.label("activity_timestamp"),
+        db.literal("original_post").label("item_type")
+    ).filter(Post.is_visible == True, not_blocked_clause(viewer_id, Post.user_id))
+    if section_id:
+        posts_q = posts_q.filter(Post.section_id == section_id)
+    if author_ids is not None:
+        posts_q = posts_q.filter(Post.user_id.in_(author_ids))
+    if cursor_pos:
+        posts_q = posts_q.filter(_keyset_before(Post.timestamp, Post.id, cursor_pos))
+    posts_q = posts_q.order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit)
+    branches = [posts_q.subquery()]
+
+    # En las secciones solo se listan publicaciones originales, igual que en view_section.
+    if not section_id:
+        shares_q = db.session.query(
+            SharedPost.id.label("item_id"),
+            SharedPost.timestamp.label("activity_timestamp"),
+            db.literal("shared_post").label("item_type")
+        ).join(Post, Post.id == SharedPost.original_post_id).filter(
+            Post.is_visible == True,
+            not_blocked_clause(viewer_id, SharedPost.user_id),
+            not_blocked_clause(viewer_id, Post.user_id)
+        )
+        if author_ids is not None:
+            shares_q = shares_q.filter(SharedPost.user_id.in_(author_ids))
+        if cursor_pos:
+            shares_q = shares_q.filter(_keyset_before(SharedPost.timestamp, SharedPost.id, cursor_pos))
+        shares_q = shares_q.order_by(SharedPost.timestamp.desc(), SharedPost.id.desc()).limit(limit)
+        branches.append(shares_q.subquery())
+
+    feed_sub = union_all(*[db.select(branch.c.item_id, branch.c.activity_timestamp, branch.c.item_type) for branch in branches]).subquery()
+    return db.session.query(feed_sub.c.item_id, feed_sub.c.activity_timestamp, feed_sub.c.item_type).order_by(
+        desc(feed_sub.c.activity_timestamp), desc(feed_sub.c.item_id)
+    ).limit(limit)
+
+# Se aplica sobre el texto ya escapado: una URL puede contener &amp; pero termina en cualquier otra entidad.
+# Un hashtag no empieza dentro de una palabra ni de una entidad (&#39;) y necesita al menos una letra.
+CONTENT_TOKEN_PATTERN = re.compile(r'(?P<url>https?://(?:[^\s<>&]|&amp;)+)|(?P<mention>@(?P<slug>[a-zA-Z0-9_]+))|(?P<hashtag>(?<![\w&])#(?P<tag>\w*[^\W\d_]\w*))')
+URL_TRAILING_PUNCTUATION = '.,;:!?)'
+
+def render_content_html(text):
+    """
+    Genera el HTML que se guarda con una publicación o comentario: texto escapado, URLs y #hashtags enlazados y
+    @menciones enlazadas solo si el perfil existe (una consulta para todas). Se llama al escribir, nunca al leer.
+    Las menciones enlazan por id de usuario (ver_perfil_por_id), así que siguen funcionando si el slug cambia.
+    """
+    if not text:
+        return text
+    html = str(escape(text))
+    slugs = {match.group('slug').lower() for match in CONTENT_TOKEN_PATTERN.finditer(html) if match.group('slug')}
+    mentioned_ids = {}
+    if slugs:
+        mentioned_ids = dict(db.session.query(Profile.slug_lower, Profile.user_id).filter(Profile.slug_lower.in_(slugs)))
+
+    def reemplazar(match):
+        if match.group('url'):
+            url = match.group('url')
+            trailing = ''
+            while url and url[-1] in URL_TRAILING_PUNCTUATION:
+                url, trailing = url[:-1], url[-1] + trailing
+            return f'<a href="{url}" target="_blank" rel="noopener noreferrer nofollow">{url}</a>{trailing}'
+        if match.group('hashtag'):
+            return f'<a href="{url_for("ver_hashtag", nombre=match.group("tag").casefold()[:100])}">{match.group(0)}</a>'
+        user_id = mentioned_ids.get(match.group('slug').lower())
+        if not user_id:
+            return match.group(0)
+        return f'<a href="{url_for("ver_perfil_por_id", user_id=user_id)}">{match.group(0)}</a>'
+    return CONTENT_TOKEN_PATTERN.sub(reemplazar, html)
+
+def stored_content_html(item):
+    """HTML guardado de una publicación, comentario o cita; las filas aún sin rellenar se escapan al vuelo."""
+    if isinstance(item, SharedPost):
+        html, text = item.quote_content_html, item.quote_content
+    else:
+        html, text = item.content_html, item.content
+    if html is not None:
+        return html
+    return render_user_content(text)
+
+def render_user_content(text):
+    """Escapa el texto de un usuario y enlaza las menciones."""
+    if not text:
+        return text
+    return procesar_menciones_para_mostrar(str(escape(text)))
+
+def _keyset_after(timestamp_col, id_col, cursor_pos):
+    """Condición 'estrictamente posterior al cursor' en orden (timestamp ASC, id ASC)."""
+    cursor_ts, cursor_id = cursor_pos
+    return or_(timestamp_col > cursor_ts, and_(timestamp_col == cursor_ts, id_col > cursor_id))
+
+def load_comment_trees(post_ids, viewer_id, limit=COMMENTS_PER_PAGE, cursor_pos=None, root_comment_id=None,
+                       replies_cursor_pos=None, replies_limit=COMMENT_REPLIES_PER_PAGE,
+                       max_depth=COMMENT_TREE_MAX_DEPTH, max_nodes=COMMENT_TREE_MAX_NODES):
+    """
+    Carga con una sola consulta recursiva (CTE) los hilos de comentarios visibles de varias publicaciones
+    y los monta en memoria. Por publicación se toman `limit` comentarios raíz a partir del cursor (o solo
+    `root_comment_id`, con sus respuestas directas a partir de `replies_cursor_pos`), y de cada comentario
+    como mucho `replies_limit` respuestas por nivel hasta `max_depth` niveles, con un máximo de `max_nodes`
+    comentarios por publicación. Devuelve {post_id: (comentarios_raíz, next_cursor)}; cada comentario lleva
+    `tree_replies`, `has_more_replies`, `replies_cursor` y `viewer_reaction`.
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return {}
+
+    if root_comment_id:
+        anchor = db.select(Comment.id.label('id'), db.literal(0).label('depth')).where(
+            Comment.id == root_comment_id, Comment.post_id.in_(post_ids), Comment.is_visible == True
+        )
+    else:
+        # Una rama con su propio LIMIT por publicación, igual que build_feed_query: cada una es un rango del índice
+        # (post_id, parent_comment_id, timestamp, id) y no se recorren todos los comentarios raíz de una publicación viral.
+        branches = []
+        for post_id in post_ids:
+            root_q = db.select(Comment.id).where(
+                Comment.post_id == post_id, Comment.parent_comment_id == None, Comment.is_visible == True
+            )
+            if cursor_pos:
+                root_q = root_q.where(_keyset_after(Comment.timestamp, Comment.id, cursor_pos))
+            branches.append(root_q.order_by(Comment.timestamp.asc(), Comment.id.asc()).limit(limit + 1).subquery())
+        roots_sub = union_all(*[db.select(branch.c.id) for branch in branches]).subquery()
+        anchor = db.select(roots_sub.c.id.label('id'), db.literal(0).label('depth'))
+    tree = anchor.cte('comment_tree', recursive=True)
+    # Las respuestas de cada comentario se limitan dentro del CTE (una más para saber si hay otra página),
+    # por el índice (parent_comment_id, timestamp, id): un hilo viral no hace recorrer todas sus respuestas.
+    # SQLite no admite funciones de ventana en la parte recursiva, así que se usa una subconsulta con LIMIT.
+    sibling = db.aliased(Comment)
+    sibling_filters = [sibling.parent_comment_id == tree.c.id, sibling.is_visible == True]
+    if replies_cursor_pos:
+        sibling_filters.append(or_(tree.c.depth > 0, _keyset_after(sibling.timestamp, sibling.id, replies_cursor_pos)))
+    page_of_replies = db.select(sibling.id).where(*sibling_filters).order_by(
+        sibling.timestamp.asc(), sibling.id.asc()
+    ).limit(replies_limit + 1).correlate(tree)
+    tree = tree.union_all(
+        db.select(Comment.id, tree.c.depth + 1).select_from(Comment).join(tree, Comment.parent_comment_id == tree.c.id)
+        .where(Comment.id.in_(page_of_replies), tree.c.depth < max_depth)
+    )
+    # El máximo de nodos se aplica por publicación, para que un hilo muy activo no deje sin comentarios a las demás.
+    ranked = db.select(tree.c.id, tree.c.depth, func.row_number().over(
+        partition_by=Comment.post_id, order_by=(tree.c.depth, Comment.timestamp, Comment.id)
+    ).label('node_position')).join(Comment, Comment.id == tree.c.id).subquery()
+    rows = db.session.query(Comment, ranked.c.depth).join(ranked, ranked.c.id == Comment.id).filter(
+        ranked.c.node_position <= max_nodes
+    ).options(
+        joinedload(Comment.author).joinedload(User.profile)
+    ).order_by(ranked.c.depth, Comment.timestamp, Comment.id).all()
+
+    by_id = {}
+    for comment, depth in rows:
+        comment.tree_replies = []
+        comment.viewer_reaction = None
+        by_id[comment.id] = comment
+    roots = {}
+    for comment, depth in rows:
+        if depth == 0:
+            roots.setdefault(comment.post_id, []).append(comment)
+        elif comment.parent_comment_id in by_id:
+            by_id[comment.parent_comment_id].tree_replies.append(comment)
+    for comment in by_id.values():
+        if len(comment.tree_replies) > replies_limit:
+            comment.tree_replies = comment.tree_replies[:replies_limit]
+            comment.has_more_replies = True
+        elif replies_cursor_pos and comment.id == root_comment_id:
+            comment.has_more_replies = False  # reply_count incluye las respuestas de páginas anteriores
+        else:
+            comment.has_more_replies = comment.reply_count > len(comment.tree_replies)
+        # "Ver más respuestas" sigue tras la última respuesta mostrada (o desde el principio si no se cargó ninguna).
+        last_reply = comment.tree_replies[-1] if comment.tree_replies else None
+        comment.replies_cursor = encode_feed_cursor(last_reply.timestamp, last_reply.id) if last_reply else None
+
+    if viewer_id and by_id:
+        for reaction in db.session.query(CommentReaction).filter(
+            CommentReaction.comment_id.in_(list(by_id)), CommentReaction.user_id == viewer_id
+        ):
+            by_id[reaction.comment_id].viewer_reaction = reaction
+
+    trees = {}
+    for post_id in post_ids:
+        post_roots = roots.get(post_id, [])
+        next_cursor = None
+        if len(post_roots) > limit:
+            post_roots = post_roots[:limit]
+            next_cursor = encode_feed_cursor(post_roots[-1].timestamp, post_roots[-1].id)
+        trees[post_id] = (post_roots, next_cursor)
+    return trees
+
+def build_post_cards(post_ids, viewer_id, snippets=None, comments_limit=FEED_COMMENTS_PREVIEW):
+    """
+    Construye los diccionarios que espera _post_card.html para un conjunto de publicaciones.
+    Usa un número fijo de consultas (publicaciones con autor, perfil, sección y contadores;
+    reacción del visitante; árbol de comentarios), sea cual sea el tamaño de la página.
+    De cada publicación se incluyen los primeros `comments_limit` hilos de comentarios.
+    `snippets` ({(item_type, id): texto resaltado}, ver load_search_snippets) sustituye al contenido.
+    """
+    post_ids = set(post_ids)
+    snippets = snippets or {}
+    if not post_ids:
+        return {}
+
+    posts = db.session.query(Post).options(
+        joinedload(Post.author).joinedload(User.profile),
+        joinedload(Post.section)
+    ).filter(Post.id.in_(post_ids)).all()
+
+    viewer_reactions = {}
+    if viewer_id:
+        viewer_reactions = {r.post_id: r for r in db.session.query(PostReaction).filter(
+            PostReaction.post_id.in_(post_ids), PostReaction.user_id == viewer_id)}
+
+    comment_trees = load_comment_trees(post_ids, viewer_id, limit=comments_limit) if comments_limit else {}
+
+    cards = {}
+    for post in posts:
+        author_profile = post.author.profile if post.author else None
+        cards[post.id] = {
+            'item_type': 'original_post',
+            'id': post.id,
+            'autor_id_post': post.user_id,
+            'username': author_profile.username if author_profile and author_profile.username else (post.author.username if post.author else _("Usuario")),
+            'slug': author_profile.slug if author_profile and author_profile.slug else '#',
+            'photo': author_profile.photo if author_profile else None,
+            'timestamp': post.timestamp,
+            'activity_timestamp': post.timestamp,
+            'content': (render_search_snippet(snippets[('original_post', post.id)]) if ('original_post', post.id) in snippets else stored_content_html(post)) or '',
+            'image_filename': post.image_filename,
+            'preview_url': post.preview_url,
+            'preview_title': post.preview_title,
+            'preview_description': post.preview_description,
+            'preview_image_url': post.preview_image_url,
+            'section_name': post.section.name if post.section else None,
+            'section_slug': post.section.slug if post.section else None,
+            'user_reaction': viewer_reactions.get(post.id),
+            'total_reactions': post.reaction_count,
+            'comments': comment_trees.get(post.id, ([], None))[0],
+            'comments_next_cursor': comment_trees.get(post.id, ([], None))[1],
+            'comment_count': post.comment_count,
+            'share_count': post.share_count,
+        }
+    return cards
+
+def hydrate_feed_rows(rows, viewer_id, snippets=None):
+    """
+    Carga en bloque los items de las filas (item_id, activity_timestamp, item_type) de un feed,
+    conservando su orden. Se usa en el feed, las secciones, los perfiles y la búsqueda.
+    """
+    share_ids = [row.item_id for row in rows if row.item_type == 'shared_post']
+    shares = {}
+    if share_ids:
+        shares = {share.id: share for share in db.session.query(SharedPost).options(
+            joinedload(SharedPost.user).joinedload(User.profile)
+        ).filter(SharedPost.id.in_(share_ids))}
+
+    post_ids = {row.item_id for row in rows if row.item_type == 'original_post'}
+    post_ids.update(share.original_post_id for share in shares.values())
+    cards = build_post_cards(post_ids, viewer_id, snippets)
+    snippets = snippets or {}
+
+    items = []
+    for row in rows:
+        if row.item_type == 'original_post':
+            if row.item_id in cards:
+                items.append(cards[row.item_id])
+            continue
+        shared_post = shares.get(row.item_id)
+        if not shared_post or shared_post.original_post_id not in cards:
+            continue
+        sharer_profile = shared_post.user.profile if shared_post.user else None
+        items.append({
+            'item_type': 'shared_post',
+            'share_id': shared_post.id,
+            'sharer_username': sharer_profile.username if sharer_profile and sharer_profile.username else (shared_post.user.username if shared_post.user else _("Usuario")),
+            'sharer_slug': sharer_profile.slug if sharer_profile and sharer_profile.slug else '#',
+            'share_timestamp': shared_post.timestamp,
+            'activity_timestamp': shared_post.timestamp,
+            'timestamp': shared_post.timestamp,
+            'quote_content': render_search_snippet(snippets[('shared_post', shared_post.id)]) if ('shared_post', shared_post.id) in snippets else stored_content_html(shared_post),
+            'original_post': cards[shared_post.original_post_id],
+        })
+    return items
+
+def load_feed_page(viewer_id, section_id=None, cursor=None, limit=POSTS_PER_PAGE):
+    """Devuelve (items, next_cursor) para una página del feed."""
+    rows = build_feed_query(viewer_id, section_id=section_id, cursor_pos=decode_feed_cursor(cursor), limit=limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_feed_cursor(rows[-1].activity_timestamp, rows[-1].item_id) if rows and has_more else None
+    return hydrate_feed_rows(rows, viewer_id), next_cursor
+
+# --- NOTIFICACIONES (PAGINACIÓN POR CURSOR) ---
+
+def encode_notification_cursor(notif):
+    return ('r' if notif.leida else 'u') + encode_feed_cursor(notif.timestamp, notif.id)
+
+def decode_notification_cursor(cursor):
+    """Devuelve (leida, (timestamp, id)) a partir de un cursor de notificaciones, o None si no es válido."""
+    if not cursor or cursor[0] not in 'ur':
+        return None
+    position = decode_feed_cursor(cursor[1:])
+    return (cursor[0] == 'r', position) if position else None
+
+def load_notifications_page(user_id, cursor=None, limit=NOTIFICATIONS_PER_PAGE):
+    """
+    Devuelve (notificaciones, next_cursor): primero las no leídas y después las leídas, cada grupo de
+    más reciente a más antigua. Cada grupo es un rango del índice (user_id, leida, timestamp, id),
+    así que el coste no depende de cuántas notificaciones acumule la cuenta.
+    """
+    decoded = decode_notification_cursor(cursor)
+    notifications = []
+    for leida in (False, True):
+        if decoded and decoded[0] and not leida:
+            continue  # El cursor ya está en las leídas.
+        group_q = Notification.query.filter(Notification.user_id == user_id, Notification.leida == leida)
+        if decoded and decoded[0] == leida:
+            group_q = group_q.filter(_keyset_before(Notification.timestamp, Notification.id, decoded[1]))
+        notifications += group_q.order_by(Notification.timestamp.desc(), Notification.id.desc()).limit(limit + 1 - len(notifications)).all()
+        if len(notifications) > limit:
+            break
+
+    has_more = len(notifications) > limit
+    notifications = notifications[:limit]
+    next_cursor = encode_notification_cursor(notifications[-1]) if notifications and has_more else None
+    return notifications, next_cursor
+
+# --- MENSAJES (PAGINACIÓN POR CURSOR) ---
+
+def get_or_create_direct_conversation(user_id, other_user_id):
+    """
+    Devuelve la conversación directa entre dos usuarios, creándola si no existe. La búsqueda es un punto del
+    índice único (min_user_id, max_user_id), que también impide duplicados si dos peticiones la crean a la vez.
+    No hace commit.
+    """
+    pair = (min(user_id, other_user_id), max(user_id, other_user_id))
+    conversation = Conversation.query.filter_by(min_user_id=pair[0], max_user_id=pair[1]).first()
+    if conversation:
+        return conversation
+    conversation = _claim_unkeyed_direct_conversation(pair)
+    if conversation:
+        return conversation
+    try:
+        with db.session.begin_nested():
+            conversation = Conversation(min_user_id=pair[0], max_user_id=pair[1])
+            db.session.add(conversation)
+            db.session.flush() # Para obtener el ID
+            db.session.add_all([
+                ConversationParticipant(conversation_id=conversation.id, user_id=user_id),
+                ConversationParticipant(conversation_id=conversation.id, user_id=other_user_id)
+            ])
+    except IntegrityError:
+        # Otra petición la creó a la vez.
+        conversation = Conversation.query.filter_by(min_user_id=pair[0], max_user_id=pair[1]).first()
+    return conversation
+
+def _claim_unkeyed_direct_conversation(pair):
+    """
+    Busca por participantes una conversación directa de la pareja creada antes de existir la clave
+    (min_user_id, max_user_id) y se la asigna, para no depender de haber ejecutado backfill-conversation-pairs.
+    Devuelve None si no hay ninguna. No hace commit.
+    """
+    other = aliased(ConversationParticipant)
+    member = aliased(ConversationParticipant)
+    member_count = db.session.query(func.count(member.id)).filter(
+        member.conversation_id == Conversation.id
+    ).scalar_subquery()
+    conversation = Conversation.query.join(
+        ConversationParticipant, ConversationParticipant.conversation_id == Conversation.id
+    ).join(other, other.conversation_id == Conversation.id).filter(
+        Conversation.min_user_id == None,
+        ConversationParticipant.user_id == pair[0], other.user_id == pair[1],
+        member_count == 2
+    ).order_by(Conversation.updated_at.desc()).first()
+    if not conversation:
+        return None
+    try:
+        with db.session.begin_nested():
+            conversation.min_user_id, conversation.max_user_id = pair
+    except IntegrityError:
+        # Otra petición reclamó la clave a la vez.
+        return Conversation.query.filter_by(min_user_id=pair[0], max_user_id=pair[1]).first()
+    return conversation
+
+def load_messages_page(conversation_id, cursor=None, limit=MESSAGES_PER_PAGE):
+    """
+    Devuelve (mensajes, older_cursor): los `limit` mensajes anteriores al cursor (o los últimos si no hay
+    cursor) en orden cronológico. Se leen hacia atrás sobre el índice (conversation_id, timestamp, id),
+    así que abrir una conversación cuesta lo mismo tenga diez mensajes o cien mil.
+    """
+    messages_q = Message.query.filter(Message.conversation_id == conversation_id)
+    cursor_pos = decode_feed_cursor(cursor)
+    if cursor_pos:
+        messages_q = messages_q.filter(_keyset_before(Message.timestamp, Message.id, cursor_pos))
+    messages = messages_q.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    older_cursor = encode_feed_cursor(messages[-1].timestamp, messages[-1].id) if has_more else None
+    messages.reverse()
+    return messages, older_cursor
+
+def mark_conversation_read(participant, message_id=None, other_user_id=None):
+    """
+    Avanza el cursor de lectura de un participante hasta `message_id` (como mucho hasta el último mensaje; sin
+    `message_id`, hasta el último), ajusta sus no leídos y avisa al otro participante. Devuelve el nuevo cursor
+    o None si no cambió. No hace commit.
+    """
+    last_message_id = participant.last_message_id
+    if last_message_id is None:
+        # Resumen sin inicializar (conversación anterior al resumen): el último mensaje se lee de la tabla.
+        last_message_id = db.session.query(func.max(Message.id)).filter(Message.conversation_id == participant.conversation_id).scalar()
+        if last_message_id is None:
+            return None
+    message_id = last_message_id if message_id is None else min(message_id, last_message_id)
+    if message_id <= (participant.last_read_message_id or 0):
+        return None
+
+    previous_read_id = participant.last_read_message_id or 0
+    if message_id == participant.last_message_id:
+        # unread_count se leyó en la misma fila que last_message_id: son justo los no leídos hasta ese mensaje.
+        marked_read = participant.unread_count
+    else:
+        # Lectura parcial (llegaron mensajes mientras tanto): lo que se marca es un rango del índice (conversation_id, id)
+        marked_read = Message.query.filter(
+            Message.conversation_id == participant.conversation_id,
+            Message.sender_id != participant.user_id,
+            Message.id > previous_read_id,
+            Message.id <= message_id
+        ).count()
+    # Resta relativa y condicionada al cursor leído: no pisa los incrementos de api_enviar_mensaje ni descuenta
+    # dos veces si otra petición avanzó el cursor a la vez.
+    updated = db.session.query(ConversationParticipant).filter(
+        ConversationParticipant.id == participant.id,
+        func.coalesce(ConversationParticipant.last_read_message_id, 0) == previous_read_id
+    ).update({
+        ConversationParticipant.last_read_message_id: message_id,
+        ConversationParticipant.unread_count: case(
+            (ConversationParticipant.unread_count > marked_read, ConversationParticipant.unread_count - marked_read),
+            else_=0
+        )
+    }, synchronize_session=False)
+    db.session.expire(participant, ['last_read_message_id', 'unread_count'])
+    if not updated:
+        return None
+    # Los mensajes de un usuario bloqueado no estaban sumados en el contador.
+    if marked_read > 0 and not (other_user_id and other_user_id in get_blocked_and_blocking_ids(participant.user_id)):
+        increment_counter(User, participant.user_id, User.unread_messages_count, -marked_read)
+    publish_event(conversation_channel(participant.conversation_id), 'read',
+                  {'user_id': participant.user_id, 'last_read_message_id': message_id})
+    return message_id
+
+# --- MODO 'TOP' DEL FEED ---
+
+def calculate_hot_score(reaction_count, comment_count, share_count, timestamp, now=None):
+    """Interacciones ponderadas (reacciones, comentarios, compartidos) que decaen con la edad de la publicación."""
+    now = now or datetime.now(timezone.utc)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    age_hours = max((now - timestamp).total_seconds() / 3600, 0)
+    points = reaction_count + 2 * comment_count + 3 * share_count + 1
+    return points / pow(age_hours + 2, HOT_SCORE_GRAVITY)
+
+def encode_rank_cursor(score, item_id):
+    return f"{score!r}_{item_id}"
+
+def decode_rank_cursor(cursor):
+    """Devuelve (puntuación, id) a partir de un cursor del modo 'top', o None si no es válido."""
+    if not cursor:
+        return None
+    try:
+        score_str, item_id_str = cursor.rsplit('_', 1)
+        return float(score_str), int(item_id_str)
+    except (ValueError, TypeError):
+        return None
+
+def load_top_feed_page(viewer_id, section_id=None, cursor=None, limit=POSTS_PER_PAGE):
+    """
+    Devuelve (items, next_cursor) para una página del modo 'top': publicaciones ordenadas por
+    (hot_score, id) mediante los índices de la tabla posts, sin agregar reacciones ni comentarios.
+    """
+    posts_q = db.session.query(
+        Post.id.label("item_id"),
+        Post.timestamp.label("activity_timestamp"),
+        db.literal("original_post").label("item_type"),
+        Post.hot_score
+    ).filter(Post.is_visible == True, Post.hot_score > 0, not_blocked_clause(viewer_id, Post.user_id))
+    if section_id:
+        posts_q = posts_q.filter(Post.section_id == section_id)
+    cursor_pos = decode_rank_cursor(cursor)
+    if cursor_pos:
+        posts_q = posts_q.filter(_keyset_before(Post.hot_score, Post.id, cursor_pos))
+    rows = posts_q.order_by(Post.hot_score.desc(), Post.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_rank_cursor(rows[-1].hot_score, rows[-1].item_id) if rows and has_more else None
+    return hydrate_feed_rows(rows, viewer_id), next_cursor
+
+def load_feed_page_for_order(viewer_id, order, section_id=None, cursor=None):
+    if order == 'top':
+        return load_top_feed_page(viewer_id, section_id=section_id, cursor=cursor)
+    return load_feed_page(viewer_id, section_id=section_id, cursor=cursor)
+
+# --- BÚSQUEDA DE TEXTO COMPLETO ---
+#
+# Postgres: índices GIN sobre to_tsvector() del contenido de posts (solo visibles) y de las citas de
+# shared_posts. SQLite: tablas FTS5 de contenido externo mantenidas por triggers, que también retiran
+# del índice las publicaciones ocultas. Ambos se crean tras db.create_all() o con rebuild-search-index.
+
+SEARCH_TEXT_CONFIG = 'simple'
+# Delimitadores del resaltado que devuelve la base de datos; se convierten en <mark> después de escapar el texto.
+SEARCH_HIGHLIGHT_START = '\x02'
+SEARCH_HIGHLIGHT_STOP = '\x03'
+
+SEARCH_INDEX_DDL = {
+    'postgresql': [
+        f"CREATE INDEX IF NOT EXISTS ix_posts_content_tsv ON posts USING GIN (to_tsvector('{SEARCH_TEXT_CONFIG}', content)) WHERE is_visible",
+        f"CREATE INDEX IF NOT EXISTS ix_shared_posts_quote_tsv ON shared_posts USING GIN (to_tsvector('{SEARCH_TEXT_CONFIG}', quote_content)) WHERE quote_content IS NOT NULL",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(content, content='posts', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts WHEN new.is_visible BEGIN "
+        "INSERT INTO posts_fts(rowid, content) VALUES (new.id, new.content); END",
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts WHEN old.is_visible BEGIN "
+        "INSERT INTO posts_fts(posts_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_au_old AFTER UPDATE OF content, is_visible ON posts WHEN old.is_visible BEGIN "
+        "INSERT INTO posts_fts(posts_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS posts_fts_au_new AFTER UPDATE OF content, is_visible ON posts WHEN new.is_visible BEGIN "
+        "INSERT INTO posts_fts(rowid, content) VALUES (new.id, new.content); END",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS shared_posts_fts USING fts5(quote_content, content='shared_posts', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS shared_posts_fts_ai AFTER INSERT ON shared_posts WHEN new.quote_content IS NOT NULL BEGIN "
+        "INSERT INTO shared_posts_fts(rowid, quote_content) VALUES (new.id, new.quote_content); END",
+        "CREATE TRIGGER IF NOT EXISTS shared_posts_fts_ad AFTER DELETE ON shared_posts WHEN old.quote_content IS NOT NULL BEGIN "
+        "INSERT INTO shared_posts_fts(shared_posts_fts, rowid, quote_content) VALUES ('delete', old.id, old.quote_content); END",
+        "CREATE TRIGGER IF NOT EXISTS shared_posts_fts_au_old AFTER UPDATE OF quote_content ON shared_posts WHEN old.quote_content IS NOT NULL BEGIN "
+        "INSERT INTO shared_posts_fts(shared_posts_fts, rowid, quote_content) VALUES ('delete', old.id, old.quote_content); END",
+        "CREATE TRIGGER IF NOT EXISTS shared_posts_fts_au_new AFTER UPDATE OF quote_content ON shared_posts WHEN new.quote_content IS NOT NULL BEGIN "
+        "INSERT INTO shared_posts_fts(rowid, quote_content) VALUES (new.id, new.quote_content); END",
+    ],
+}
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    """Crea los índices de texto completo del dialecto actual (idempotente)."""
+    for statement in SEARCH_INDEX_DDL.get(connection.dialect.name, []):
+        connection.execute(text(statement))
+
+def _search_match_query(query):
+    """Convierte el texto del usuario en una consulta FTS5 segura: cada palabra entre comillas, todas obligatorias."""
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"' for word in words)
+
+def _search_keyset_before(rank_col, item_type, id_col, cursor_pos):
+    """Condición 'estrictamente posterior en los resultados' en orden (rank DESC, item_type DESC, id DESC)."""
+    cursor_rank, cursor_type, cursor_id = cursor_pos
+    if item_type < cursor_type:
+        return rank_col <= cursor_rank
+    if item_type > cursor_type:
+        return rank_col < cursor_rank
+    return _keyset_before(rank_col, id_col, (cursor_rank, cursor_id))
+
+def encode_search_cursor(row):
+    return f"{row.rank!r}_{'p' if row.item_type == 'original_post' else 's'}{row.item_id}"
+
+def decode_search_cursor(cursor):
+    """Devuelve (rank, item_type, id) a partir de un cursor de búsqueda, o None si no es válido."""
+    if not cursor:
+        return None
+    try:
+        rank_str, item_str = cursor.rsplit('_', 1)
+        item_type = {'p': 'original_post', 's': 'shared_post'}[item_str[0]]
+        return float(rank_str), item_type, int(item_str[1:])
+    except (ValueError, TypeError, KeyError, IndexError):
+        return None
+
+SEARCH_HIGHLIGHT_PATTERN = re.compile(f'{SEARCH_HIGHLIGHT_START}(.*?){SEARCH_HIGHLIGHT_STOP}', re.S)
+
+def render_search_snippet(snippet):
+    """
+    Renderiza un texto resaltado por la base de datos con render_content_html (el mismo HTML que se guarda al
+    escribir: URLs, hashtags y menciones) y marca con <mark> los términos resaltados, solo fuera de las etiquetas.
+    """
+    terms = {term.casefold() for term in SEARCH_HIGHLIGHT_PATTERN.findall(snippet) if term.strip()}
+    html = render_content_html(snippet.replace(SEARCH_HIGHLIGHT_START, '').replace(SEARCH_HIGHLIGHT_STOP, '')) or ''
+    if not terms:
+        return html
+    alternatives = '|'.join(re.escape(str(escape(term))) for term in sorted(terms, key=len, reverse=True))
+    term_pattern = re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)', re.IGNORECASE)
+    return ''.join(
+        part if part.startswith('<') else term_pattern.sub(lambda match: f'<mark class="p-0">{match.group(0)}</mark>', part)
+        for part in re.split(r'(<[^>]*>)', html)
+    )
+
+def load_search_snippets(rows, query):
+    """Resalta en la base de datos el texto de los resultados de una página: {(item_type, id): texto}."""
+    post_ids = [row.item_id for row in rows if row.item_type == 'original_post']
+    share_ids = [row.item_id for row in rows if row.item_type == 'shared_post']
+    snippets = {}
+    if db.engine.dialect.name == 'postgresql':
+        tsquery = func.websearch_to_tsquery(db.literal_column(f"'{SEARCH_TEXT_CONFIG}'"), query)
+        options = f'StartSel="{SEARCH_HIGHLIGHT_START}", StopSel="{SEARCH_HIGHLIGHT_STOP}", HighlightAll=true'
+        config = db.literal_column(f"'{SEARCH_TEXT_CONFIG}'")
+        if post_ids:
+            for item_id, snippet in db.session.query(Post.id, func.ts_headline(config, Post.content, tsquery, options)).filter(Post.id.in_(post_ids)):
+                snippets[('original_post', item_id)] = snippet
+        if share_ids:
+            for item_id, snippet in db.session.query(SharedPost.id, func.ts_headline(config, SharedPost.quote_content, tsquery, options)).filter(SharedPost.id.in_(share_ids)):
+                snippets[('shared_post', item_id)] = snippet
+    else:
+        match_query = _search_match_query(query)
+        for table_name, item_type, item_ids in (('posts_fts', 'original_post', post_ids), ('shared_posts_fts', 'shared_post', share_ids)):
+            if not item_ids:
+                continue
+            fts = db.literal_column(table_name)
+            rowid = db.literal_column(f'{table_name}.rowid')
+            for item_id, snippet in db.session.query(rowid, func.highlight(fts, 0, SEARCH_HIGHLIGHT_START, SEARCH_HIGHLIGHT_STOP)).select_from(
+                db.table(table_name)
+            ).filter(fts.op('MATCH')(match_query), rowid.in_(item_ids)):
+                snippets[(item_type, item_id)] = snippet
+    return snippets
+
+def load_search_page(viewer_id, query, cursor=None, limit=SEARCH_RESULTS_PER_PAGE):
+    """
+    Devuelve (items, next_cursor) para una página de resultados de búsqueda en publicaciones y citas,
+    ordenados por relevancia con paginación por cursor. Cada rama usa el índice de texto completo del
+    dialecto, aplica el cursor y el límite por separado y el resaltado se calcula solo para la página.
+    """
+    cursor_pos = decode_search_cursor(cursor)
+    if db.engine.dialect.name == 'postgresql':
+        config = db.literal_column(f"'{SEARCH_TEXT_CONFIG}'")
+        tsquery = func.websearch_to_tsquery(config, query)
+        post_vector = func.to_tsvector(config, Post.content)
+        share_vector = func.to_tsvector(config, SharedPost.quote_content)
+        post_rank = func.ts_rank_cd(post_vector, tsquery)
+        share_rank = func.ts_rank_cd(share_vector, tsquery)
+        posts_q = db.session.query(Post.id.label("item_id"), db.literal("original_post").label("item_type"), post_rank.label("rank")).filter(
+            post_vector.bool_op('@@')(tsquery)
+        )
+        shares_q = db.session.query(SharedPost.id.label("item_id"), db.literal("shared_post").label("item_type"), share_rank.label("rank")).filter(
+            SharedPost.quote_content != None, share_vector.bool_op('@@')(tsquery)
+        )
+    else:
+        match_query = _search_match_query(query)
+        if not match_query:
+            return [], None
+        posts_fts, shares_fts = db.literal_column('posts_fts'), db.literal_column('shared_posts_fts')
+        # bm25() es menor cuanto más relevante: se invierte para ordenar igual que ts_rank_cd.
+        post_rank = -func.bm25(posts_fts)
+        share_rank = -func.bm25(shares_fts)
+        posts_q = db.session.query(Post.id.label("item_id"), db.literal("original_post").label("item_type"), post_rank.label("rank")).select_from(
+            db.table('posts_fts')
+        ).join(Post, Post.id == db.literal_column('posts_fts.rowid')).filter(posts_fts.op('MATCH')(match_query))
+        shares_q = db.session.query(SharedPost.id.label("item_id"), db.literal("shared_post").label("item_type"), share_rank.label("rank")).select_from(
+            db.table('shared_posts_fts')
+        ).join(SharedPost, SharedPost.id == db.literal_column('shared_posts_fts.rowid')).filter(shares_fts.op('MATCH')(match_query))
+
+    posts_q = posts_q.filter(Post.is_visible == True, not_blocked_clause(viewer_id, Post.user_id))
+    shares_q = shares_q.join(Post, Post.id == SharedPost.original_post_id).filter(
+        Post.is_visible == True, # Asegurarse de que el post original no esté oculto
+        not_blocked_clause(viewer_id, SharedPost.user_id),
+        not_blocked_clause(viewer_id, Post.user_id)
+    )
+    if cursor_pos:
+        posts_q = posts_q.filter(_search_keyset_before(post_rank, 'original_post', Post.id, cursor_pos))
+        shares_q = shares_q.filter(_search_keyset_before(share_rank, 'shared_post', SharedPost.id, cursor_pos))
+    branches = [
+        posts_q.order_by(post_rank.desc(), Post.id.desc()).limit(limit + 1).subquery(),
+        shares_q.order_by(share_rank.desc(), SharedPost.id.desc()).limit(limit + 1).subquery()
+    ]
+    results_sub = union_all(*[db.select(branch.c.item_id, branch.c.item_type, branch.c.rank) for branch in branches]).subquery()
+    rows = db.session.query(results_sub.c.item_id, results_sub.c.item_type, results_sub.c.rank).order_by(
+        desc(results_sub.c.rank), desc(results_sub.c.item_type), desc(results_sub.c.item_id)
+    ).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_search_cursor(rows[-1]) if rows and has_more else None
+    return hydrate_feed_rows(rows, viewer_id, snippets=load_search_snippets(rows, query)), next_cursor
+
+# --- MARCAS DE AGUA DEL FEED (COMPROBACIÓN DE NOVEDADES) ---
+
+# Caché por proceso: scope -> (datos de la marca, momento de lectura). La tabla feed_markers es la
+# fuente común a todos los workers; cada worker la relee como mucho una vez cada FEED_MARKER_CACHE_SECONDS.
+_feed_marker_cache = {}
+
+def feed_marker_scopes(section_slug=None):
+    """Scopes afectados por una publicación: el feed global y, si aplica, su sección."""
+    return ['global', f'section:{section_slug}'] if section_slug else ['global']
+
+def _latest_visible_post(scope):
+    posts_q = db.session.query(Post.id, Post.timestamp).filter(Post.is_visible == True)
+    if scope.startswith('section:'):
+        posts_q = posts_q.join(Section, Section.id == Post.section_id).filter(Section.slug == scope.split(':', 1)[1])
+    return posts_q.order_by(Post.timestamp.desc(), Post.id.desc()).first()
+
+def _get_or_create_feed_marker(scope):
+    marker = db.session.query(FeedMarker).get(scope)
+    if marker:
+        return marker
+    if scope.startswith('section:') and not Section.query.filter_by(slug=scope.split(':', 1)[1]).first():
+        return None
+    latest = _latest_visible_post(scope)
+    try:
+        with db.session.begin_nested():
+            marker = FeedMarker(scope=scope, latest_post_id=latest.id if latest else None,
+                                latest_timestamp=latest.timestamp if latest else None, sequence=0)
+            db.session.add(marker)
+    except IntegrityError:
+        # Otro worker la creó a la vez.
+        marker = db.session.query(FeedMarker).get(scope)
+    return marker
+
+def get_feed_marker(scope):
+    """
+    Devuelve {'latest_post_id', 'latest_timestamp', 'sequence'} de un scope, usando la caché del proceso.
+    Es de solo lectura: si la marca aún no existe (se crea en init-db o al publicar) se calcula sin guardarla.
+    """
+    cached = _feed_marker_cache.get(scope)
+    if cached and time.monotonic() - cached[1] < FEED_MARKER_CACHE_SECONDS:
+        return cached[0]
+
+    marker = db.session.query(FeedMarker).get(scope)
+    if marker:
+        data = {
+            'latest_post_id': marker.latest_post_id,
+            'latest_timestamp': parse_timestamp(marker.latest_timestamp),
+            'sequence': marker.sequence,
+        }
+    else:
+        latest = _latest_visible_post(scope)
+        data = {
+            'latest_post_id': latest.id if latest else None,
+            'latest_timestamp': parse_timestamp(latest.timestamp) if latest else None,
+            'sequence': 0,
+        }
+    _feed_marker_cache[scope] = (data, time.monotonic())
+    return data
+
+def bump_feed_markers(post):
+    """
+    Avanza las marcas del feed global y de la sección del post recién creado con un UPDATE atómico
+    (sin leer ni bloquear la fila antes); solo crea la marca si todavía no existe. No hace commit.
+    """
+    for scope in feed_marker_scopes(post.section.slug if post.section else None):
+        values = {
+            FeedMarker.latest_post_id: post.id,
+            FeedMarker.latest_timestamp: post.timestamp,
+            FeedMarker.sequence: FeedMarker.sequence + 1,
+        }
+        updated = db.session.query(FeedMarker).filter(FeedMarker.scope == scope).update(values, synchronize_session=False)
+        if not updated and _get_or_create_feed_marker(scope):
+            db.session.query(FeedMarker).filter(FeedMarker.scope == scope).update(values, synchronize_session=False)
+        _feed_marker_cache.pop(scope, None)
+
+def retreat_feed_markers(post):
+    """
+    Retrocede las marcas de los scopes de un post visible que se acaba de ocultar: descuenta una publicación
+    de la secuencia (para que check_new deje de anunciarla) y, si era la última, recalcula la última. No hace commit.
+    """
+    db.session.flush()
+    for scope in feed_marker_scopes(post.section.slug if post.section else None):
+        db.session.query(FeedMarker).filter(FeedMarker.scope == scope).update({
+            FeedMarker.sequence: case((FeedMarker.sequence > 0, FeedMarker.sequence - 1), else_=0),
+        }, synchronize_session=False)
+        latest = _latest_visible_post(scope)
+        db.session.query(FeedMarker).filter(FeedMarker.scope == scope, FeedMarker.latest_post_id == post.id).update({
+            FeedMarker.latest_post_id: latest.id if latest else None,
+            FeedMarker.latest_timestamp: latest.timestamp if latest else None,
+        }, synchronize_session=False)
+        _feed_marker_cache.pop(scope, None)
+
+# --- HASHTAGS Y TENDENCIAS ---
+
+def extract_hashtags(text):
+    """
+    Hashtags de un texto, en minúsculas, sin repetir y en orden de aparición (como mucho HASHTAGS_PER_ITEM_MAX).
+    Usa el mismo patrón que render_content_html, así que un '#' dentro de una URL no cuenta.
+    """
+    names = []
+    for match in CONTENT_TOKEN_PATTERN.finditer(str(escape(text or ''))):
+        name = match.group('tag') and match.group('tag').casefold()[:100]
+        if name and name not in names:
+            names.append(name)
+    return names[:HASHTAGS_PER_ITEM_MAX]
+
+def hashtag_bucket_start(timestamp):
+    ts = parse_timestamp(timestamp)
+    return FEED_CURSOR_EPOCH + ((ts - FEED_CURSOR_EPOCH) // HASHTAG_BUCKET) * HASHTAG_BUCKET
+
+def get_or_create_hashtags(names):
+    """Devuelve {nombre: id} creando los hashtags que falten. No hace commit."""
+    hashtag_ids = dict(db.session.query(Hashtag.name, Hashtag.id).filter(Hashtag.name.in_(names))) if names else {}
+    for name in names:
+        if name in hashtag_ids:
+            continue
+        try:
+            with db.session.begin_nested():
+                hashtag = Hashtag(name=name)
+                db.session.add(hashtag)
+            hashtag_ids[name] = hashtag.id
+        except IntegrityError:
+            # Otra petición lo creó a la vez.
+            hashtag_ids[name] = db.session.query(Hashtag.id).filter(Hashtag.name == name).scalar()
+    return hashtag_ids
+
+def increment_hashtag_buckets(hashtag_ids, bucket_start, delta=1):
+    """Suma `delta` al contador de cada hashtag en una franja, creando la fila si no existe. No hace commit."""
+    for hashtag_id in hashtag_ids:
+        bucket_filter = and_(HashtagBucket.hashtag_id == hashtag_id, HashtagBucket.bucket_start == bucket_start)
+        if db.session.query(HashtagBucket).filter(bucket_filter).update({HashtagBucket.count: HashtagBucket.count + delta}, synchronize_session=False):
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(HashtagBucket(hashtag_id=hashtag_id, bucket_start=bucket_start, count=delta))
+        except IntegrityError:
+            db.session.query(HashtagBucket).filter(bucket_filter).update({HashtagBucket.count: HashtagBucket.count + delta}, synchronize_session=False)
+
+def index_hashtags(item_type, item_id, post_id, author_id, activity_timestamp, text, count_in_trending=True):
+    """Registra los hashtags de una publicación o cita y suma un uso en su franja horaria (si cuenta en tendencias). No hace commit."""
+    names = extract_hashtags(text)
+    if not names:
+        return
+    hashtag_ids = get_or_create_hashtags(names)
+    db.session.execute(db.insert(PostHashtag), [
+        {'hashtag_id': hashtag_ids[name], 'item_type': item_type, 'item_id': item_id, 'post_id': post_id,
+         'author_id': author_id, 'activity_timestamp': activity_timestamp}
+        for name in names
+    ])
+    if count_in_trending:
+        increment_hashtag_buckets(hashtag_ids.values(), hashtag_bucket_start(activity_timestamp))
+
+def unindex_hashtags(item_type, item_id, count_in_trending=True):
+    """Borra los hashtags registrados de una publicación o cita y resta sus usos de las tendencias. No hace commit."""
+    item_filter = and_(PostHashtag.item_type == item_type, PostHashtag.item_id == item_id)
+    uses_by_bucket = {}
+    for hashtag_id, activity_timestamp in db.session.query(PostHashtag.hashtag_id, PostHashtag.activity_timestamp).filter(item_filter):
+        uses_by_bucket.setdefault(hashtag_bucket_start(activity_timestamp), []).append(hashtag_id)
+    if count_in_trending:
+        for bucket_start, hashtag_ids in uses_by_bucket.items():
+            increment_hashtag_buckets(hashtag_ids, bucket_start, -1)
+    db.session.query(PostHashtag).filter(item_filter).delete(synchronize_session=False)
+
+def unindex_post_hashtags(post):
+    """Resta de las tendencias los usos de una publicación que se oculta y de las citas que la comparten. No hace commit."""
+    uses_by_bucket = {}
+    for hashtag_id, activity_timestamp in db.session.query(PostHashtag.hashtag_id, PostHashtag.activity_timestamp).filter(
+            PostHashtag.post_id == post.id):
+        uses_by_bucket.setdefault(hashtag_bucket_start(activity_timestamp), []).append(hashtag_id)
+    for bucket_start, hashtag_ids in uses_by_bucket.items():
+        increment_hashtag_buckets(hashtag_ids, bucket_start, -1)
+
+def hashtag_window_start(now=None):
+    """Primera franja incluida en la ventana de tendencias (la franja actual cuenta aunque esté empezada)."""
+    return hashtag_bucket_start(now or datetime.now(timezone.utc)) - TRENDING_WINDOW + HASHTAG_BUCKET
+
+# Caché por proceso de las tendencias: (lista, momento de lectura).
+_trending_cache = {}
+
+def get_trending_hashtags():
+    """[(nombre, usos)] de los hashtags más usados en TRENDING_WINDOW, sumando solo las franjas de la ventana."""
+    cached = _trending_cache.get('global')
+    if cached and time.monotonic() - cached[1] < TRENDING_CACHE_SECONDS:
+        return cached[0]
+    total = func.sum(HashtagBucket.count).label('total')
+    trending = [(name, uses) for name, uses in db.session.query(Hashtag.name, total).join(
+        HashtagBucket, HashtagBucket.hashtag_id == Hashtag.id
+    ).filter(HashtagBucket.bucket_start >= hashtag_window_start()).group_by(Hashtag.id, Hashtag.name).having(
+        func.sum(HashtagBucket.count) > 0
+    ).order_by(desc(total), Hashtag.name).limit(TRENDING_LIMIT)]
+    _trending_cache['global'] = (trending, time.monotonic())
+    return trending
+
+def load_hashtag_page(viewer_id, hashtag_id, cursor=None, limit=POSTS_PER_PAGE):
+    """Devuelve (items, next_cursor) de las publicaciones y citas con un hashtag, por el índice (hashtag_id, timestamp, id)."""
+    rows_q = db.session.query(
+        PostHashtag.item_id, PostHashtag.activity_timestamp, PostHashtag.item_type
+    ).join(Post, Post.id == PostHashtag.post_id).filter(
+        PostHashtag.hashtag_id == hashtag_id,
+        Post.is_visible == True,
+        not_blocked_clause(viewer_id, PostHashtag.author_id),
+        not_blocked_clause(viewer_id, Post.user_id)
+    )
+    cursor_pos = decode_feed_cursor(cursor)
+    if cursor_pos:
+        rows_q = rows_q.filter(_keyset_before(PostHashtag.activity_timestamp, PostHashtag.item_id, cursor_pos))
+    rows = rows_q.order_by(PostHashtag.activity_timestamp.desc(), PostHashtag.item_id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_feed_cursor(rows[-1].activity_timestamp, rows[-1].item_id) if rows and has_more else None
+    return hydrate_feed_rows(rows, viewer_id), next_cursor
+
+# --- TIMELINES DE CONTACTOS (FAN-OUT EN ESCRITURA) ---
+
+def accepted_contact_ids_select(user_id):
+    """Subconsulta con los IDs de los contactos aceptados del usuario (en ambas direcciones)."""
+    sent_req = db.session.query(Contact.receptor_id).filter(Contact.solicitante_id == user_id, Contact.estado == 'aceptado')
+    received_req = db.session.query(Contact.solicitante_id).filter(Contact.receptor_id == user_id, Contact.estado == 'aceptado')
+    return sent_req.union(received_req)
+
+def fanout_timeline_entry(author_id, item_type, item_id, post_id, activity_timestamp):
+    """
+    Escribe una actividad nueva en el timeline de cada contacto aceptado del autor.
+    Si el autor supera TIMELINE_FANOUT_MAX_CONTACTS no se escribe nada y queda marcado
+    para que sus contactos lean su actividad al vuelo; si vuelve a bajar del límite, se copia
+    a los timelines lo que publicó mientras tanto (incluida esta actividad). No hace commit.
+    """
+    author = db.session.query(User).get(author_id)
+    if not author:
+        return
+    # Conteo acotado a TIMELINE_FANOUT_MAX_CONTACTS + 1: no se carga la lista de un autor con miles de contactos.
+    bounded_contacts = accepted_contact_ids_select(author_id).limit(TIMELINE_FANOUT_MAX_CONTACTS + 1).subquery()
+    contact_count = db.session.query(func.count()).select_from(bounded_contacts).scalar()
+    was_fanout_on_read = author.timeline_fanout_on_read
+    author.timeline_fanout_on_read = contact_count > TIMELINE_FANOUT_MAX_CONTACTS
+    if author.timeline_fanout_on_read:
+        if not was_fanout_on_read:
+            author.timeline_fanout_on_read_since = activity_timestamp
+        return
+    contact_ids = [row[0] for row in accepted_contact_ids_select(author_id).all()] if contact_count else []
+    if was_fanout_on_read:
+        since = author.timeline_fanout_on_read_since
+        author.timeline_fanout_on_read_since = None
+        insert_timeline_entries(missing_timeline_entries(contact_ids, author_id, since=since))
+        return
+    if not contact_ids:
+        return
+
+    db.session.execute(db.insert(TimelineEntry), [{
+        'user_id': contact_id,
+        'author_id': author_id,
+        'item_type': item_type,
+        'item_id': item_id,
+        'post_id': post_id,
+        'activity_timestamp': activity_timestamp,
+    } for contact_id in contact_ids])
+
+def trim_timelines_between(user_a_id, user_b_id):
+    """Quita de ambos timelines la actividad del otro usuario (contacto eliminado o bloqueado). No hace commit."""
+    db.session.query(TimelineEntry).filter(or_(
+        and_(TimelineEntry.user_id == user_a_id, TimelineEntry.author_id == user_b_id),
+        and_(TimelineEntry.user_id == user_b_id, TimelineEntry.author_id == user_a_id)
+    )).delete(synchronize_session=False)
+
+def missing_timeline_entries(reader_ids, author_id, since=None, limit=TIMELINE_BACKFILL_ITEMS):
+    """
+    Filas de TimelineEntry que faltan en los timelines de `reader_ids` con las últimas `limit` actividades
+    de `author_id` (solo las posteriores a `since`, si se indica). Los bloqueos se vuelven a filtrar al leer.
+    """
+    rows = build_feed_query(author_id, limit=limit, author_ids=[author_id]).all()
+    if since:
+        rows = [row for row in rows if parse_timestamp(row.activity_timestamp) >= parse_timestamp(since)]
+    if not rows or not reader_ids:
+        return []
+    share_ids = [row.item_id for row in rows if row.item_type == 'shared_post']
+    share_post_ids = dict(db.session.query(SharedPost.id, SharedPost.original_post_id).filter(SharedPost.id.in_(share_ids)).all()) if share_ids else {}
+
+    existing = set(db.session.query(TimelineEntry.user_id, TimelineEntry.item_type, TimelineEntry.item_id).filter(
+        TimelineEntry.user_id.in_(reader_ids), TimelineEntry.author_id == author_id,
+        TimelineEntry.activity_timestamp >= rows[-1].activity_timestamp
+    ).all())
+    return [{
+        'user_id': reader_id,
+        'author_id': author_id,
+        'item_type': row.item_type,
+        'item_id': row.item_id,
+        'post_id': row.item_id if row.item_type == 'original_post' else share_post_ids[row.item_id],
+        'activity_timestamp': row.activity_timestamp,
+    } for reader_id in reader_ids for row in rows if (reader_id, row.item_type, row.item_id) not in existing]
+
+def insert_timeline_entries(entries):
+    if entries:
+        db.session.execute(db.insert(TimelineEntry), entries)
+
+def backfill_timelines_between(user_a_id, user_b_id, limit=TIMELINE_BACKFILL_ITEMS):
+    """Copia la actividad reciente de cada uno en el timeline del otro al aceptar un contacto. No hace commit."""
+    for reader_id, author_id in ((user_a_id, user_b_id), (user_b_id, user_a_id)):
+        author = db.session.query(User).get(author_id)
+        if not author or author.timeline_fanout_on_read:
+            continue
+        insert_timeline_entries(missing_timeline_entries([reader_id], author_id, limit=limit))
+
+def load_contacts_feed_page(viewer_id, cursor=None, limit=POSTS_PER_PAGE):
+    """
+    Devuelve (items, next_cursor) del feed de contactos: un rango indexado sobre el timeline
+    materializado del usuario, más la actividad leída al vuelo de los contactos con fan-out en lectura.
+    """
+    cursor_pos = decode_feed_cursor(cursor)
+
+    entries_q = db.session.query(
+        TimelineEntry.item_id.label("item_id"),
+        TimelineEntry.activity_timestamp.label("activity_timestamp"),
+        TimelineEntry.item_type.label("item_type")
+    ).join(Post, Post.id == TimelineEntry.post_id).filter(
+        TimelineEntry.user_id == viewer_id,
+        Post.is_visible == True,
+        not_blocked_clause(viewer_id, Post.user_id)
+    )
+    if cursor_pos:
+        entries_q = entries_q.filter(_keyset_before(TimelineEntry.activity_timestamp, TimelineEntry.item_id, cursor_pos))
+    rows = entries_q.order_by(TimelineEntry.activity_timestamp.desc(), TimelineEntry.item_id.desc()).limit(limit + 1).all()
+
+    fanout_on_read_ids = [row[0] for row in db.session.query(User.id).filter(
+        User.timeline_fanout_on_read == True,
+        User.id.in_(accepted_contact_ids_select(viewer_id))
+    ).all()]
+    if fanout_on_read_ids:
+        seen = {(row.item_type, row.item_id) for row in rows}
+        pulled = build_feed_query(viewer_id, cursor_pos=cursor_pos, limit=limit + 1, author_ids=fanout_on_read_ids).all()
+        rows.extend(row for row in pulled if (row.item_type, row.item_id) not in seen)
+        rows.sort(key=lambda row: (parse_timestamp(row.activity_timestamp), row.item_id), reverse=True)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_feed_cursor(rows[-1].activity_timestamp, rows[-1].item_id) if rows and has_more else None
+    return hydrate_feed_rows(rows, viewer_id), next_cursor
 
 def extract_first_url(text):
     if not text:
@@ -560,7 +2456,7 @@ def check_policy_acceptance(f):
         if request.endpoint in ['accept_policies', 'logout', 'static']:
             return f(*args, **kwargs)
 
-        user = db.session.query(User).get(session['user_id'])
+        user = get_current_user()
         if user and not user.accepted_policies:
             flash(_('Antes de continuar, debes aceptar nuestra Política de Privacidad y Términos de Servicio.'), 'info')
             return redirect(url_for('accept_policies'))
@@ -568,54 +2464,13 @@ def check_policy_acceptance(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Inserta este bloque junto a tus otros decoradores (login_required, etc.)
-
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash(_('Debes iniciar sesión para acceder a esta página.'), 'warning')
-            return redirect(url_for('index', next=request.url))
-        user = User.query.get(session['user_id'])
-        if not user or user.role != 'admin':
-            flash(_('No tienes permiso para acceder a esta página de administración.'), 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
-
-def coordinator_or_admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash(_('Debes iniciar sesión para acceder a esta página.'), 'warning')
-            return redirect(url_for('index', next=request.url))
-        user = User.query.get(session['user_id'])
-        if not user or user.role not in ['coordinator', 'admin']:
-            flash(_('No tienes los permisos necesarios (se requiere ser al menos coordinador).'), 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
-
-def moderator_or_higher_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash(_('Debes iniciar sesión para acceder a esta página.'), 'warning')
-            return redirect(url_for('index', next=request.url))
-        user = User.query.get(session['user_id'])
-        if not user or user.role not in ['moderator', 'coordinator', 'admin']:
-            flash(_('No tienes los permisos necesarios (se requiere ser al menos moderador).'), 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
-
 def check_sanctions_and_block(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
             return f(*args, **kwargs)
 
-        user = db.session.query(User).get(session['user_id'])
+        user = get_current_user()
         if not user:
             session.clear()
             return redirect(url_for('login'))
@@ -640,7 +2495,7 @@ def check_sanctions_and_block_api(f):
         if 'user_id' not in session:
             return jsonify(success=False, error=_('Autenticación requerida.')), 401
 
-        user = db.session.query(User).get(session['user_id'])
+        user = get_current_user()
         if not user:
             session.clear()
             return jsonify(success=False, error=_('Usuario no encontrado.')), 401
@@ -663,7 +2518,7 @@ def admin_required(f):
         if 'user_id' not in session:
             flash(_('Debes iniciar sesión para acceder a esta página.'), 'warning')
             return redirect(url_for('login', next=request.url))
-        user = db.session.query(User).get(session['user_id'])
+        user = get_current_user()
         if not user or user.role != 'admin':
             flash(_('No tienes permiso para acceder a esta página de administración.'), 'danger')
             return redirect(url_for('index'))
@@ -676,7 +2531,7 @@ def coordinator_or_admin_required(f):
         if 'user_id' not in session:
             flash(_('Debes iniciar sesión para acceder a esta página.'), 'warning')
             return redirect(url_for('login', next=request.url))
-        user = db.session.query(User).get(session['user_id'])
+        user = get_current_user()
         if not user or user.role not in ['coordinator', 'admin']:
             flash(_('No tienes los permisos necesarios (se requiere ser al menos coordinador) para acceder a esta página.'), 'danger')
             return redirect(url_for('index'))
@@ -689,7 +2544,7 @@ def moderator_or_higher_required(f):
         if 'user_id' not in session:
             flash(_('Debes iniciar sesión para acceder a esta página.'), 'warning')
             return redirect(url_for('login', next=request.url))
-        user = db.session.query(User).get(session['user_id'])
+        user = get_current_user()
         if not user or user.role not in ['moderator', 'coordinator', 'admin']:
             flash(_('No tienes los permisos necesarios (se requiere ser al menos moderador) para acceder a esta página.'), 'danger')
             return redirect(url_for('index'))
@@ -722,25 +2577,14 @@ def inject_global_vars():
     if not user_id:
         return base_context  # Devolver solo el contexto base para invitados
 
-    user = db.session.query(User).options(joinedload(User.profile)).get(user_id)
+    user = get_current_user()
     if not user:
         session.clear()
         return base_context
 
-    num_notificaciones_no_leidas = db.session.query(Notification).filter_by(user_id=user_id, leida=False).count()
-    
-    excluded_ids = get_blocked_and_blocking_ids(user_id)
-    unread_messages_query = db.session.query(func.count(Message.id))\
-        .join(ConversationParticipant, Message.conversation_id == ConversationParticipant.conversation_id)\
-        .filter(
-            ConversationParticipant.user_id == user_id,
-            Message.sender_id != user_id,
-            Message.is_read == False
-        )
-    if excluded_ids:
-        unread_messages_query = unread_messages_query.filter(Message.sender_id.notin_(excluded_ids))
-    
-    num_mensajes_no_leidos = unread_messages_query.scalar() or 0
+    # Los contadores se mantienen en cada escritura, así que la barra no necesita consultas adicionales.
+    num_notificaciones_no_leidas = max(user.unread_notifications_count, 0)
+    num_mensajes_no_leidos = max(user.unread_messages_count, 0)
 
     # Añadir las variables específicas del usuario al diccionario base
     base_context.update(
@@ -902,36 +2746,123 @@ def feed():
         return redirect(url_for('profile'))
 
     all_sections = db.session.query(Section).order_by(Section.name).all()
+    feed_order = request.args.get('orden', 'recientes')
+    if feed_order not in FEED_ORDERS:
+        feed_order = 'recientes'
     
-    # La paginación y carga de posts se maneja principalmente por la ruta API /api/feed
-    # Esta ruta solo renderiza el esqueleto de la página. La carga inicial de posts se omite
-    # para favorecer la carga dinámica con JavaScript.
+    # La primera página se renderiza en el servidor; las siguientes se piden a /api/feed con el cursor.
+    feed_items, next_cursor = load_feed_page_for_order(user_id_actual, feed_order)
     return render_template('feed.html', 
-                           posts=[], # Los posts se cargarán dinámicamente
+                           posts=feed_items,
+                           next_cursor=next_cursor,
+                           feed_order=feed_order,
+                           feed_marker=get_feed_marker('global')['sequence'],
                            sections=all_sections,
+                           trending_hashtags=get_trending_hashtags(),
                            POSTS_PER_PAGE=POSTS_PER_PAGE)
+
+@app.route('/feed/contactos')
+@login_required
+@check_policy_acceptance
+def contacts_feed():
+    user_id_actual = session['user_id']
+    if not check_profile_completion(user_id_actual):
+        flash(_('Debes completar tu perfil para ver el feed y publicar.'), 'warning')
+        return redirect(url_for('profile'))
+
+    feed_items, next_cursor = load_contacts_feed_page(user_id_actual, cursor=request.args.get('cursor', '').strip())
+    has_contacts = accepted_contact_ids_select(user_id_actual).first() is not None
+    return render_template('feed_contacts.html',
+                           posts=feed_items,
+                           next_cursor=next_cursor,
+                           has_contacts=has_contacts)
+
+@app.route('/api/feed')
+@login_required_api
+def api_feed():
+    """Devuelve el HTML de la siguiente página del feed (general o de una sección) a partir de un cursor."""
+    user_id_actual = session['user_id']
+    section_slug = request.args.get('section_slug', '').strip()
+    cursor = request.args.get('cursor', '').strip()
+    feed_order = request.args.get('orden', 'recientes')
+
+    section_id = None
+    if section_slug:
+        section = Section.query.filter_by(slug=section_slug).first()
+        if not section:
+            return Response('', status=404)
+        section_id = section.id
+
+    feed_items, next_cursor = load_feed_page_for_order(user_id_actual, feed_order, section_id=section_id, cursor=cursor)
+    if not feed_items:
+        return Response('', mimetype='text/html')
+
+    response = Response(render_template('_post_card_list.html', posts=feed_items), mimetype='text/html')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@app.route('/api/feed/check_new')
+@login_required_api
+def api_feed_check_new():
+    """
+    Indica cuántas publicaciones nuevas hay desde que se cargó la página. Solo consulta la marca
+    de agua del scope (en caché), nunca la tabla de publicaciones.
+    """
+    section_slug = request.args.get('section_slug', '').strip()
+    marker = get_feed_marker(feed_marker_scopes(section_slug)[-1])
+
+    since_timestamp = None
+    timestamp_str = request.args.get('timestamp', '').strip()
+    if timestamp_str:
+        try:
+            since_timestamp = parse_timestamp(datetime.fromisoformat(timestamp_str))
+        except ValueError:
+            return jsonify(success=False, error='invalid_timestamp'), 400
+
+    since_sequence = request.args.get('since', type=int)
+    if since_sequence is not None:
+        new_items_count = max(marker['sequence'] - since_sequence, 0)
+    elif marker['latest_timestamp'] and since_timestamp:
+        new_items_count = 1 if marker['latest_timestamp'] > since_timestamp else 0
+    else:
+        new_items_count = 0
+
+    return jsonify(
+        success=True,
+        new_items_count=new_items_count,
+        marker=marker['sequence'],
+        latest_timestamp=marker['latest_timestamp'].isoformat() if marker['latest_timestamp'] else None
+    )
+
+@app.route('/post/<int:post_id>')
+@login_required
+@check_policy_acceptance
+def ver_publicacion_individual(post_id):
+    user_id_actual = session['user_id']
+    post = db.session.query(Post).get(post_id)
+    if not post or not post.is_visible:
+        flash(_('Publicación no encontrada.'), 'danger')
+        return redirect(url_for('feed'))
+
+    excluded_ids = get_blocked_and_blocking_ids(user_id_actual)
+    if post.user_id in excluded_ids:
+        flash(_('No puedes ver esta publicación.'), 'danger')
+        return redirect(url_for('feed'))
+
+    post_card = build_post_cards([post.id], user_id_actual, comments_limit=0)[post.id]
+    thread_id = request.args.get('thread', type=int)
+    comments, comments_next_cursor = load_comment_trees(
+        [post.id], user_id_actual,
+        cursor_pos=decode_feed_cursor(request.args.get('comments_cursor', '').strip()),
+        root_comment_id=thread_id,
+        replies_cursor_pos=decode_feed_cursor(request.args.get('replies_cursor', '').strip()) if thread_id else None
+    )[post.id]
+    post_card.update(comments=comments, comments_next_cursor=comments_next_cursor)
+    return render_template('ver_post.html', post=post_card, thread_id=thread_id)
     
 # Inserta este bloque después de la ruta /feed en app.py
 
-def highlight_term(text_content, query):
-    """Resalta el término de búsqueda en el texto, ignorando mayúsculas/minúsculas."""
-    if not query or not text_content:
-        return text_content
-    try:
-        # Escapa el query para tratar caracteres especiales de regex como texto normal
-        escaped_query = re.escape(query)
-        # re.sub para reemplazar el término encontrado por el mismo término envuelto en un <span>
-        highlighted_text = re.sub(
-            f'({escaped_query})',
-            r'<mark class="p-0">\g<0></mark>', # Usamos la etiqueta <mark> de Bootstrap
-            text_content,
-            flags=re.IGNORECASE
-        )
-        return highlighted_text
-    except Exception as e:
-        print(f"Error durante el resaltado del término de búsqueda: {e}")
-        return text_content
-
 @app.route('/search')
 @login_required
 @check_policy_acceptance
@@ -942,39 +2873,12 @@ def search():
         return render_template('search_results.html', posts=[], query=query)
 
     user_id_actual = session['user_id']
-    excluded_ids = get_blocked_and_blocking_ids(user_id_actual)
-
-    # Búsqueda en el contenido de publicaciones originales
-    posts_found = Post.query.filter(
-        Post.content.ilike(f'%{query}%'),
-        Post.is_visible == True,
-        Post.user_id.notin_(excluded_ids)
-    ).order_by(Post.timestamp.desc()).all()
-
-    # Búsqueda en el contenido de las citas de publicaciones compartidas
-    shares_found = SharedPost.query.join(Post, Post.id == SharedPost.original_post_id).filter(
-        SharedPost.quote_content.ilike(f'%{query}%'),
-        Post.is_visible == True, # Asegurarse de que el post original no esté oculto
-        SharedPost.user_id.notin_(excluded_ids),
-        Post.user_id.notin_(excluded_ids)
-    ).order_by(SharedPost.timestamp.desc()).all()
-
-    # Combinar y procesar resultados
-    search_results = []
-    for post in posts_found:
-        # Crea una copia del contenido para no modificar el objeto original de la BBDD
-        display_content = highlight_term(post.content, query)
-        search_results.append({'item_type': 'original_post', 'data': post, 'display_content': display_content})
 
-    for share in shares_found:
-        display_content = highlight_term(share.quote_content, query)
-        search_results.append({'item_type': 'shared_post', 'data': share, 'display_content': display_content})
-
-    # Ordenar resultados combinados por fecha de actividad (más recientes primero)
-    search_results.sort(key=lambda x: x['data'].timestamp, reverse=True)
+    # Búsqueda de texto completo en publicaciones y citas, por relevancia y paginada por cursor
+    search_results, next_cursor = load_search_page(user_id_actual, query, cursor=request.args.get('cursor', '').strip())
 
     # Renderizar la plantilla con los resultados
-    return render_template('search_results.html', posts=search_results, query=query)
+    return render_template('search_results.html', posts=search_results, query=query, next_cursor=next_cursor)
 
 # Inserta este bloque después de la ruta /search en app.py
 
@@ -986,18 +2890,14 @@ def search():
 def notificaciones():
     user_id_actual = session['user_id']
     
-    # Lógica con SQLAlchemy para obtener notificaciones y marcar como leídas las que se vean
-    notificaciones_list = Notification.query.filter_by(user_id=user_id_actual)\
-        .order_by(Notification.leida.asc(), Notification.timestamp.desc())\
-        .all()
-    
-    # Marcar como leídas solo al cargar la página (se puede refinar con JS como lo tenías)
-    # for notif in notificaciones_list:
-    #     if not notif.leida:
-    #         notif.leida = True
-    # db.session.commit()
+    notificaciones_list, next_cursor = load_notifications_page(user_id_actual, cursor=request.args.get('cursor', '').strip())
+    # Cursor de la notificación no leída más reciente visible: "marcar todas" no tocará las que lleguen después.
+    newest_unread = next((notif for notif in notificaciones_list if not notif.leida), None)
 
-    return render_template('notificaciones.html', notificaciones=notificaciones_list)
+    return render_template('notificaciones.html',
+                           notificaciones=notificaciones_list,
+                           next_cursor=next_cursor,
+                           mark_read_cursor=encode_feed_cursor(newest_unread.timestamp, newest_unread.id) if newest_unread else None)
 
 @app.route('/sections')
 @login_required
@@ -1013,28 +2913,44 @@ def view_section(slug_seccion):
     user_id_actual = session['user_id']
 
     section = Section.query.filter_by(slug=slug_seccion).first_or_404()
+    feed_order = request.args.get('orden', 'recientes')
+    if feed_order not in FEED_ORDERS:
+        feed_order = 'recientes'
     
-    excluded_ids = get_blocked_and_blocking_ids(user_id_actual)
-    
-    # Query para posts en la sección, excluyendo usuarios bloqueados
-    posts_in_section = Post.query.filter(
-        Post.section_id == section.id,
-        Post.is_visible == True,
-        Post.user_id.notin_(excluded_ids)
-    ).order_by(Post.timestamp.desc()).limit(50).all()
-
-    # Se necesita pasar el item como diccionario para que _post_card.html funcione
-    feed_items = [{'item_type': 'original_post', 'data': post} for post in posts_in_section]
+    feed_items, next_cursor = load_feed_page_for_order(user_id_actual, feed_order, section_id=section.id)
 
     # También obtener todas las secciones para el formulario de publicación
     all_sections = Section.query.order_by(Section.name.asc()).all()
 
     return render_template('view_section.html', 
                            posts=feed_items, 
+                           next_cursor=next_cursor,
+                           feed_order=feed_order,
+                           feed_marker=get_feed_marker(f'section:{section.slug}')['sequence'],
                            section_name=section.name,
                            section_slug=section.slug,
                            sections=all_sections)
 
+@app.route('/tag/<nombre>')
+@login_required
+@check_policy_acceptance
+def ver_hashtag(nombre):
+    user_id_actual = session['user_id']
+    hashtag = Hashtag.query.filter_by(name=nombre.casefold()).first_or_404()
+
+    feed_items, next_cursor = load_hashtag_page(user_id_actual, hashtag.id, cursor=request.args.get('cursor', '').strip())
+    # Usos en las últimas 24 h: unas pocas franjas del índice (hashtag_id, bucket_start), sin contar publicaciones.
+    recent_uses = db.session.query(func.coalesce(func.sum(HashtagBucket.count), 0)).filter(
+        HashtagBucket.hashtag_id == hashtag.id,
+        HashtagBucket.bucket_start >= hashtag_window_start()
+    ).scalar()
+    return render_template('tag.html',
+                           posts=feed_items,
+                           next_cursor=next_cursor,
+                           hashtag_name=hashtag.name,
+                           recent_uses=recent_uses,
+                           trending_hashtags=get_trending_hashtags())
+
 @app.route('/post', methods=['POST'])
 @login_required
 @check_sanctions_and_block
@@ -1081,12 +2997,18 @@ def post():
         new_post = Post(
             user_id=user_id_actual,
             content=contenido_post,
+            content_html=render_content_html(contenido_post),
             image_filename=nombre_archivo_imagen,
             section_id=int(section_id_str) if section_id_str and section_id_str.isdigit() else None,
             **preview_data
         )
         db.session.add(new_post)
         db.session.flush() 
+        new_post.hot_score = calculate_hot_score(0, 0, 0, new_post.timestamp)
+
+        fanout_timeline_entry(user_id_actual, 'original_post', new_post.id, new_post.id, new_post.timestamp)
+        bump_feed_markers(new_post)
+        index_hashtags('original_post', new_post.id, new_post.id, user_id_actual, new_post.timestamp, contenido_post)
         
         if contenido_post:
             procesar_menciones_y_notificar(contenido_post, user_id_actual, new_post.id, "publicación")
@@ -1110,13 +3032,18 @@ def delete_post(post_id):
         flash(_('Publicación no encontrada.'), 'danger')
         return redirect(request.referrer or url_for('feed'))
 
-    current_user = db.session.query(User).get(user_id_actual)
+    current_user = get_current_user()
 
     if post.user_id != user_id_actual and current_user.role not in ['moderator', 'coordinator', 'admin']:
         flash(_('No tienes permiso para eliminar esta publicación.'), 'danger')
         return redirect(request.referrer or url_for('feed'))
 
+    was_visible = post.is_visible
+    if was_visible:
+        unindex_post_hashtags(post)
     post.is_visible = False
+    if was_visible:
+        retreat_feed_markers(post)
     
     if post.user_id != user_id_actual:
         log_details = f"Ocultó un post (ID: {post.id}, contenido: '{post.content[:100]}...') del usuario con ID {post.user_id}."
@@ -1135,9 +3062,7 @@ def delete_post(post_id):
 def react_to_post(post_id):
     user_id_actual = session['user_id']
     reaction_type = request.form.get('reaction_type')
-    allowed_reactions = ['like', 'love', 'haha', 'wow', 'sad', 'angry']
-
-    if not reaction_type or reaction_type not in allowed_reactions:
+    if not reaction_type or reaction_type not in REACTION_TYPES:
         return jsonify(success=False, error='invalid_reaction_type'), 400
 
     post = db.session.query(Post).get(post_id)
@@ -1150,17 +3075,20 @@ def react_to_post(post_id):
     if existing_reaction:
         if existing_reaction.reaction_type == reaction_type:
             db.session.delete(existing_reaction)
+            update_post_reaction_counters(post_id, old_type=reaction_type)
             action_taken = 'removed'
         else:
+            update_post_reaction_counters(post_id, old_type=existing_reaction.reaction_type, new_type=reaction_type)
             existing_reaction.reaction_type = reaction_type
             action_taken = 'updated'
     else:
         new_reaction = PostReaction(post_id=post_id, user_id=user_id_actual, reaction_type=reaction_type)
         db.session.add(new_reaction)
+        update_post_reaction_counters(post_id, new_type=reaction_type)
         action_taken = 'created'
     
     db.session.commit()
-    total_reactions = db.session.query(PostReaction).filter_by(post_id=post_id).count()
+    total_reactions = post.reaction_count
 
     return jsonify(
         success=True, 
@@ -1202,25 +3130,30 @@ def comment(post_id):
             post_id=post_id, 
             user_id=user_id_actual, 
             content=contenido_comentario, 
+            content_html=render_content_html(contenido_comentario),
             parent_comment_id=parent_comment_id
         )
         db.session.add(new_comment)
         db.session.flush()
+        increment_counter(Post, post_id, Post.comment_count)
+        if parent_comment_id:
+            increment_counter(Comment, parent_comment_id, Comment.reply_count)
 
         commenter_profile = db.session.query(Profile).filter_by(user_id=user_id_actual).first()
         commenter_slug = commenter_profile.slug if commenter_profile else "#"
         commenter_name = commenter_profile.username if commenter_profile else _("Usuario")
         commenter_link_html = f'<a href="{url_for("ver_perfil", slug_perfil=commenter_slug)}">@{commenter_name}</a>'
-        post_link_html = f'<a href="{url_for("ver_publicacion_individual", post_id=post_id)}#comment-{new_comment.id}">{_("publicación")}</a>'
+        post_url = url_for("ver_publicacion_individual", post_id=post_id)
+        post_link_html = f'<a href="{post_url}#comment-{new_comment.id}">{_("publicación")}</a>'
 
         if parent_comment_id:
             parent_comment = db.session.query(Comment).get(parent_comment_id)
             if parent_comment and parent_comment.user_id != user_id_actual and parent_comment.user_id not in excluded_ids:
                 mensaje_notif = _('%(commenter_link)s ha respondido a tu comentario en una %(post_link)s.') % {'commenter_link': commenter_link_html, 'post_link': post_link_html}
-                create_system_notification(parent_comment.user_id, mensaje_notif, 'respuesta_comentario', post_id)
+                create_aggregated_notifications([parent_comment.user_id], 'respuesta_comentario', post_id, user_id_actual, commenter_link_html, post_url, mensaje_notif)
         elif post.user_id != user_id_actual:
             mensaje_notif = _('%(commenter_link)s ha comentado en tu %(post_link)s.') % {'commenter_link': commenter_link_html, 'post_link': post_link_html}
-            create_system_notification(post.user_id, mensaje_notif, 'nuevo_comentario', post_id)
+            create_aggregated_notifications([post.user_id], 'nuevo_comentario', post_id, user_id_actual, commenter_link_html, post_url, mensaje_notif)
 
         if contenido_comentario:
             # Llamamos a procesar menciones después de las notificaciones principales
@@ -1246,7 +3179,7 @@ def delete_comment(comment_id):
         flash(_('Comentario no encontrado.'), 'danger')
         return redirect(request.referrer or url_for('feed'))
 
-    current_user = db.session.query(User).get(user_id_actual)
+    current_user = get_current_user()
     if not current_user:
         return redirect(url_for('logout'))
 
@@ -1254,6 +3187,10 @@ def delete_comment(comment_id):
         flash(_('No tienes permiso para eliminar este comentario.'), 'danger')
         return redirect(url_for('feed'))
 
+    if comment.is_visible:
+        increment_counter(Post, comment.post_id, Post.comment_count, -1)
+        if comment.parent_comment_id:
+            increment_counter(Comment, comment.parent_comment_id, Comment.reply_count, -1)
     comment.is_visible = False
     post_id_original = comment.post_id
 
@@ -1276,9 +3213,7 @@ def delete_comment(comment_id):
 def react_to_comment(comment_id):
     user_id_actual = session['user_id']
     reaction_type = request.form.get('reaction_type')
-    allowed_reactions = ['like', 'love', 'haha', 'wow', 'sad', 'angry']
-
-    if not reaction_type or reaction_type not in allowed_reactions:
+    if not reaction_type or reaction_type not in REACTION_TYPES:
         return jsonify(success=False, error='invalid_reaction_type'), 400
 
     comment = db.session.query(Comment).get(comment_id)
@@ -1291,6 +3226,7 @@ def react_to_comment(comment_id):
     if existing_reaction:
         if existing_reaction.reaction_type == reaction_type:
             db.session.delete(existing_reaction)
+            increment_counter(Comment, comment_id, Comment.reaction_count, -1)
             action_taken = 'removed'
         else:
             existing_reaction.reaction_type = reaction_type
@@ -1298,10 +3234,11 @@ def react_to_comment(comment_id):
     else:
         new_reaction = CommentReaction(comment_id=comment_id, user_id=user_id_actual, reaction_type=reaction_type)
         db.session.add(new_reaction)
+        increment_counter(Comment, comment_id, Comment.reaction_count, 1)
         action_taken = 'created'
             
     db.session.commit()
-    total_reactions = db.session.query(CommentReaction).filter_by(comment_id=comment_id).count()
+    total_reactions = comment.reaction_count
 
     return jsonify(
         success=True,
@@ -1336,16 +3273,23 @@ def share_post(post_id):
         new_share = SharedPost(
             user_id=user_id_actual, 
             original_post_id=post_id, 
-            quote_content=quote_content if quote_content else None
+            quote_content=quote_content if quote_content else None,
+            quote_content_html=render_content_html(quote_content) if quote_content else None
         )
         db.session.add(new_share)
+        db.session.flush()
+
+        increment_counter(Post, post_id, Post.share_count)
+        fanout_timeline_entry(user_id_actual, 'shared_post', new_share.id, post_id, new_share.timestamp)
+        index_hashtags('shared_post', new_share.id, post_id, user_id_actual, new_share.timestamp, quote_content)
         
         if post_original.user_id != user_id_actual:
             sharer_profile = db.session.query(Profile).filter_by(user_id=user_id_actual).first()
             sharer_username = sharer_profile.username if sharer_profile else _("Alguien")
             sharer_slug = sharer_profile.slug if sharer_profile else "#"
             sharer_link = f'<a href="{url_for("ver_perfil", slug_perfil=sharer_slug)}">@{sharer_username}</a>'
-            post_link = f'<a href="{url_for("ver_publicacion_individual", post_id=post_id)}">{_("publicación")}</a>'
+            post_url = url_for("ver_publicacion_individual", post_id=post_id)
+            post_link = f'<a href="{post_url}">{_("publicación")}</a>'
             
             if quote_content:
                 mensaje = _('%(sharer_link)s ha citado tu %(post_link)s.') % {'sharer_link': sharer_link, 'post_link': post_link}
@@ -1354,7 +3298,7 @@ def share_post(post_id):
                 mensaje = _('%(sharer_link)s ha compartido tu %(post_link)s.') % {'sharer_link': sharer_link, 'post_link': post_link}
                 tipo_notif = 'share_post'
             
-            create_system_notification(post_original.user_id, mensaje, tipo_notif, post_id)
+            create_aggregated_notifications([post_original.user_id], tipo_notif, post_id, user_id_actual, sharer_link, post_url, mensaje)
         
         db.session.commit()
         flash(_('Publicación compartida correctamente.'), 'success')
@@ -1423,27 +3367,10 @@ def iniciar_conversacion(receptor_id):
         flash(_('Solo puedes enviar mensajes a tus contactos.'), 'danger')
         return redirect(request.referrer or url_for('feed'))
 
-    # Buscar conversación existente
-    existing_conversation = Conversation.query.join(Conversation.participants, aliased=True).filter(
-        ConversationParticipant.user_id == user_id_actual
-    ).join(Conversation.participants, aliased=True).filter(
-        ConversationParticipant.user_id == receptor_id
-    ).first()
-
-    if existing_conversation:
-        return redirect(url_for('ver_conversacion', conversation_id=existing_conversation.id))
-    else:
-        # Crear nueva conversación
-        new_conv = Conversation()
-        db.session.add(new_conv)
-        db.session.flush() # Para obtener el ID
-        
-        p1 = ConversationParticipant(conversation_id=new_conv.id, user_id=user_id_actual)
-        p2 = ConversationParticipant(conversation_id=new_conv.id, user_id=receptor_id)
-        db.session.add_all([p1, p2])
-        
-        db.session.commit()
-        return redirect(url_for('ver_conversacion', conversation_id=new_conv.id))
+    # Buscar o crear la conversación directa
+    conversation = get_or_create_direct_conversation(user_id_actual, receptor_id)
+    db.session.commit()
+    return redirect(url_for('ver_conversacion', conversation_id=conversation.id))
 
 # --- RUTAS DE MENSAJERÍA ---
 
@@ -1456,55 +3383,65 @@ def mensajes():
         flash(_('Por favor, completa tu perfil para usar la mensajería.'), 'warning')
         return redirect(url_for('profile'))
 
-    excluded_ids = get_blocked_and_blocking_ids(user_id_actual)
-    
-    # Subconsulta para encontrar el último mensaje de cada conversación
-    last_message_subq = db.session.query(
-        Message.conversation_id,
-        func.max(Message.timestamp).label('last_timestamp')
-    ).group_by(Message.conversation_id).subquery()
-
-    # Consulta principal
+    # Una sola consulta sobre el resumen de cada participante, ordenada por última actividad
+    other_participant = aliased(ConversationParticipant)
     conversations = db.session.query(
-        Conversation,
+        ConversationParticipant,
         User,
-        Profile,
-        Message
+        Profile
     ).join(
-        Conversation.participants
+        other_participant, and_(other_participant.conversation_id == ConversationParticipant.conversation_id, other_participant.user_id != user_id_actual)
     ).join(
-        User, User.id == ConversationParticipant.user_id
+        User, User.id == other_participant.user_id
     ).outerjoin(
         Profile, Profile.user_id == User.id
-    ).join(
-        last_message_subq, last_message_subq.c.conversation_id == Conversation.id
-    ).join(
-        Message, and_(Message.conversation_id == last_message_subq.c.conversation_id, Message.timestamp == last_message_subq.c.last_timestamp)
     ).filter(
         ConversationParticipant.user_id == user_id_actual, # Participante actual
-        User.id != user_id_actual, # El otro participante
-        User.id.notin_(excluded_ids) # No bloqueado
-    ).order_by(desc(last_message_subq.c.last_timestamp)).all()
+        ConversationParticipant.last_message_at != None, # Solo conversaciones con mensajes
+        not_blocked_clause(user_id_actual, User.id) # No bloqueado
+    ).order_by(desc(ConversationParticipant.last_message_at), desc(ConversationParticipant.id)).all()
+
+    # Conversaciones con mensajes pero sin resumen (anteriores a él): se resumen al vuelo en vez de ocultarlas.
+    legacy = db.session.query(ConversationParticipant, User, Profile).join(
+        other_participant, and_(other_participant.conversation_id == ConversationParticipant.conversation_id, other_participant.user_id != user_id_actual)
+    ).join(
+        User, User.id == other_participant.user_id
+    ).outerjoin(
+        Profile, Profile.user_id == User.id
+    ).filter(
+        ConversationParticipant.user_id == user_id_actual,
+        ConversationParticipant.last_message_id == None,
+        db.session.query(Message.id).filter(Message.conversation_id == ConversationParticipant.conversation_id).exists(),
+        not_blocked_clause(user_id_actual, User.id)
+    ).all()
+    summaries = [(summary.conversation_id, {
+        'last_message_id': summary.last_message_id,
+        'last_message_preview': summary.last_message_preview,
+        'last_message_at': summary.last_message_at,
+        'unread_count': summary.unread_count
+    }, other_user, other_profile) for summary, other_user, other_profile in conversations]
+    if legacy:
+        summaries += [(participant.conversation_id, conversation_summary(participant), other_user, other_profile)
+                      for participant, other_user, other_profile in legacy]
+        summaries.sort(key=lambda row: parse_timestamp(row[1]['last_message_at']), reverse=True)
 
     # Procesar resultados para la plantilla
     conversations_list = []
-    for conv, other_user, other_profile, last_msg in conversations:
-        unread_count = db.session.query(Message).filter(
-            Message.conversation_id == conv.id,
-            Message.sender_id != user_id_actual,
-            Message.is_read == False
-        ).count()
-
+    for conversation_id, summary, other_user, other_profile in summaries:
         conversations_list.append({
-            'conversation_id': conv.id,
+            'conversation_id': conversation_id,
             'other_user': {
                 'id': other_user.id,
                 'username': other_profile.username if other_profile else other_user.username,
                 'photo': other_profile.photo if other_profile else None,
                 'slug': other_profile.slug if other_profile else '#'
             },
-            'last_message': last_msg,
-            'unread_count': unread_count
+            'last_message': {
+                'id': summary['last_message_id'],
+                'body': summary['last_message_preview'],
+                'timestamp': summary['last_message_at']
+            },
+            'unread_count': summary['unread_count']
         })
 
     return render_template('mensajes.html', conversations=conversations_list)
@@ -1538,21 +3475,19 @@ def ver_conversacion(conversation_id):
             'slug': other_profile.slug if other_profile else '#'
         }
 
-    # Marcar mensajes como leídos
-    Message.query.filter(
-        Message.conversation_id == conversation_id,
-        Message.sender_id != user_id_actual,
-        Message.is_read == False
-    ).update({'is_read': True})
-    db.session.commit()
+    # Marcar la conversación como leída: se avanza el cursor de lectura del participante hasta el último mensaje
+    if mark_conversation_read(participant, other_user_id=other_participant.user_id if other_participant else None):
+        db.session.commit()
 
-    # Obtener todos los mensajes de la conversación
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp.asc()).all()
+    # Solo la última página; los anteriores se piden a api_mensajes_anteriores
+    messages, older_cursor = load_messages_page(conversation_id)
 
     return render_template('conversacion.html',
                            conversation_id=conversation_id,
                            messages=messages,
-                           other_user=other_user_data)
+                           older_cursor=older_cursor,
+                           other_user=other_user_data,
+                           other_last_read_message_id=(other_participant.last_read_message_id or 0) if other_participant else 0)
 
 @app.route('/enviar_solicitud/<int:id_receptor_solicitud>', methods=['POST'])
 @login_required
@@ -1630,8 +3565,11 @@ def aceptar_solicitud(id_solicitante):
         mensaje_notif = _('%(receptor_link)s aceptó tu solicitud de contacto.') % {'receptor_link': receptor_link_html}
         
         create_system_notification(id_solicitante, mensaje_notif, 'solicitud_aceptada', id_receptor_actual)
+        backfill_timelines_between(id_solicitante, id_receptor_actual)
+        publish_cache_invalidation('contact', id_solicitante, id_receptor_actual)
         
         db.session.commit()
+        invalidate_contact_cache(id_solicitante, id_receptor_actual)
         flash(_('Solicitud de contacto aceptada.'), 'success')
     else:
         flash(_('No se pudo aceptar la solicitud (quizás ya no estaba pendiente o no era para ti).'), 'warning')
@@ -1672,7 +3610,10 @@ def eliminar_contacto(id_otro_usuario):
     
     if contact_to_delete:
         db.session.delete(contact_to_delete)
+        trim_timelines_between(user_id_actual, id_otro_usuario)
+        publish_cache_invalidation('contact', user_id_actual, id_otro_usuario)
         db.session.commit()
+        invalidate_contact_cache(user_id_actual, id_otro_usuario)
         flash(_('Contacto eliminado.'), 'success')
     else:
         flash(_('No se encontró una relación de contacto para eliminar.'), 'info')
@@ -1703,8 +3644,15 @@ def block_user(user_to_block_id):
         ).first()
         if contact_to_delete:
             db.session.delete(contact_to_delete)
+        trim_timelines_between(blocker_id, user_to_block_id)
+        db.session.flush()
+        refresh_unread_counters(blocker_id, user_to_block_id)
+        publish_cache_invalidation('block', blocker_id, user_to_block_id)
+        publish_cache_invalidation('contact', blocker_id, user_to_block_id)
             
         db.session.commit()
+        invalidate_block_cache(blocker_id, user_to_block_id)
+        invalidate_contact_cache(blocker_id, user_to_block_id)
         flash(_('Usuario bloqueado correctamente.'), 'success')
     except IntegrityError:
         db.session.rollback()
@@ -1725,13 +3673,26 @@ def unblock_user(user_to_unblock_id):
 
     if block_record:
         db.session.delete(block_record)
+        db.session.flush()
+        refresh_unread_counters(blocker_id, user_to_unblock_id)
+        publish_cache_invalidation('block', blocker_id, user_to_unblock_id)
         db.session.commit()
+        invalidate_block_cache(blocker_id, user_to_unblock_id)
         flash(_('Usuario desbloqueado correctamente.'), 'success')
     else:
         flash(_('Este usuario no estaba en tu lista de bloqueados.'), 'info')
 
     return redirect(request.referrer or url_for('feed'))
 
+@app.route('/ver_perfil/id/<int:user_id>')
+def ver_perfil_por_id(user_id):
+    """Enlace estable de las menciones guardadas en content_html: redirige al slug actual del perfil."""
+    slug = db.session.query(Profile.slug).filter(Profile.user_id == user_id).scalar()
+    if not slug:
+        flash(_("Perfil no encontrado."), "danger")
+        return redirect(url_for('feed'))
+    return redirect(url_for('ver_perfil', slug_perfil=slug))
+
 @app.route('/ver_perfil/<slug_perfil>')
 def ver_perfil(slug_perfil):
     if not slug_perfil or not slug_perfil.strip() or slug_perfil == "#":
@@ -1769,16 +3730,7 @@ def ver_perfil(slug_perfil):
     )
     
     profile_feed_query = posts_q.union_all(shares_q).order_by(desc("activity_timestamp")).limit(50)
-    
-    profile_items = []
-    for item in profile_feed_query.all():
-        item_id, item_type = item.item_id, item.item_type
-        if item_type == 'original_post':
-            post = db.session.query(Post).options(joinedload(Post.author).joinedload(User.profile)).get(item_id)
-            if post: profile_items.append({'item_type': 'original_post', 'data': post})
-        elif item_type == 'shared_post':
-            shared_post = db.session.query(SharedPost).options(joinedload(SharedPost.original_post)).get(item_id)
-            if shared_post: profile_items.append({'item_type': 'shared_post', 'data': shared_post})
+    profile_items = hydrate_feed_rows(profile_feed_query.all(), user_id_visitante)
 
     # Lógica de estado de contacto
     estado_contacto, puede_enviar_solicitud, solicitud_pendiente_aqui = None, False, False
@@ -1838,6 +3790,11 @@ def init_db_command():
         for section_data in initial_sections:
             new_section = Section(**section_data)
             db.session.add(new_section)
+        db.session.flush()
+
+        # Las marcas de agua del feed se crean aquí (o al publicar), nunca desde las vistas de lectura.
+        for scope in ['global'] + [f"section:{section_data['slug']}" for section_data in initial_sections]:
+            _get_or_create_feed_marker(scope)
 
         db.session.commit()
         print("Base de datos inicializada y secciones pobladas correctamente.")
@@ -1846,7 +3803,342 @@ def init_db_command():
 def regenerate_slugs_command():
     """Regenera los slugs faltantes para los perfiles."""
     regenerar_slugs_si_faltan()
+    with app.app_context():
+        # Rellena slug_lower en perfiles anteriores a la columna.
+        actualizados = db.session.query(Profile).filter(
+            Profile.slug != None, or_(Profile.slug_lower == None, Profile.slug_lower != func.lower(Profile.slug))
+        ).update({Profile.slug_lower: func.lower(Profile.slug)}, synchronize_session=False)
+        db.session.commit()
+        print(f"{actualizados} slugs en minúsculas actualizados.")
     
+@app.cli.command("compute-hot-scores")
+def compute_hot_scores_command():
+    """Recalcula la puntuación del modo 'top' (pensado para ejecutarse periódicamente, p. ej. cada 10 minutos)."""
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        window_start = now - timedelta(days=HOT_SCORE_WINDOW_DAYS)
+        recent_posts = db.session.query(
+            Post.id, Post.reaction_count, Post.comment_count, Post.share_count, Post.timestamp
+        ).filter(Post.timestamp >= window_start, Post.is_visible == True).all()
+        scores = [
+            {'id': row.id, 'hot_score': calculate_hot_score(row.reaction_count, row.comment_count, row.share_count, row.timestamp, now)}
+            for row in recent_posts
+        ]
+        for start in range(0, len(scores), 1000):
+            db.session.execute(db.update(Post), scores[start:start + 1000])
+        # Las publicaciones que salen de la ventana dejan de aparecer en el modo 'top'.
+        expired = db.session.query(Post).filter(
+            Post.timestamp < window_start, Post.hot_score != 0
+        ).update({Post.hot_score: 0}, synchronize_session=False)
+        db.session.commit()
+        print(f"{len(scores)} puntuaciones recalculadas, {expired} publicaciones fuera de la ventana.")
+
+@app.cli.command("rebuild-counters")
+@click.option('--check', is_flag=True, help='Solo informa de los contadores desajustados, sin corregirlos.')
+def rebuild_counters_command(check):
+    """Recalcula los contadores desnormalizados de publicaciones y comentarios."""
+    with app.app_context():
+        expected = compute_counters()
+        post_columns = ['reaction_count'] + [f'{t}_count' for t in REACTION_TYPES] + ['comment_count', 'share_count']
+        comment_columns = ['reaction_count', 'reply_count']
+
+        fixes = []
+        for model, columns in ((Post, post_columns), (Comment, comment_columns)):
+            stored_rows = db.session.query(model.id, *[getattr(model, column) for column in columns]).yield_per(1000)
+            for row in stored_rows:
+                wanted = expected.get((model, row.id), {})
+                for column in columns:
+                    value = wanted.get(column, 0)
+                    if getattr(row, column) != value:
+                        print(f"{model.__tablename__} {row.id}: {column} = {getattr(row, column)}, esperado {value}")
+                        fixes.append((model, row.id, column, value))
+
+        if check:
+            print(f"{len(fixes)} contadores desajustados.")
+            if fixes:
+                raise SystemExit(1)
+            return
+        for model, row_id, column, value in fixes:
+            db.session.query(model).filter(model.id == row_id).update({column: value}, synchronize_session=False)
+        db.session.commit()
+        print(f"{len(fixes)} contadores corregidos.")
+
+def table_size_report(model):
+    """Filas y, en Postgres, tamaño en disco (tabla + índices) de la tabla de un modelo."""
+    rows = db.session.query(func.count(model.id)).scalar()
+    if db.engine.dialect.name != 'postgresql':
+        return f"{rows} filas"
+    size = db.session.execute(
+        text("SELECT pg_size_pretty(pg_total_relation_size(:table))"), {'table': model.__tablename__}
+    ).scalar()
+    return f"{rows} filas, {size}"
+
+@app.cli.command("prune-notifications")
+@click.option('--days', default=90, show_default=True, help='Antigüedad mínima (en días) de las notificaciones leídas a retirar.')
+@click.option('--batch-size', default=5000, show_default=True, help='Notificaciones por lote; cada lote es una transacción.')
+@click.option('--archive/--delete', default=True, show_default=True, help='Mover a notificaciones_archivo o borrar definitivamente.')
+def prune_notifications_command(days, batch_size, archive):
+    """Retira por lotes las notificaciones leídas más antiguas que --days (pensado para ejecutarse a diario)."""
+    with app.app_context():
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        print(f"Antes: {table_size_report(Notification)}")
+
+        total = 0
+        while True:
+            batch_ids = [row[0] for row in db.session.query(Notification.id).filter(
+                Notification.leida == True, Notification.timestamp < cutoff
+            ).order_by(Notification.timestamp).limit(batch_size)]
+            if not batch_ids:
+                break
+            if archive:
+                columns = ['id', 'user_id', 'mensaje', 'tipo', 'referencia_id', 'timestamp']
+                db.session.execute(db.insert(NotificationArchive).from_select(
+                    columns, db.select(*[getattr(Notification, column) for column in columns]).where(Notification.id.in_(batch_ids))
+                ))
+            db.session.query(Notification).filter(Notification.id.in_(batch_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            total += len(batch_ids)
+            print(f" -> {total} notificaciones {'archivadas' if archive else 'borradas'}...")
+
+        print(f"Después: {table_size_report(Notification)}")
+        if archive:
+            print(f"Archivo: {table_size_report(NotificationArchive)}")
+        print(f"{total} notificaciones leídas anteriores a {cutoff:%Y-%m-%d} {'archivadas' if archive else 'borradas'}.")
+
+@app.cli.command("reconcile-unread-counters")
+@click.option('--check', is_flag=True, help='Solo informa de los contadores desajustados, sin corregirlos.')
+def reconcile_unread_counters_command(check):
+    """Recalcula los contadores de notificaciones y mensajes no leídos (pensado para ejecutarse periódicamente)."""
+    with app.app_context():
+        expected = compute_unread_counters()
+        columns = ['unread_notifications_count', 'unread_messages_count']
+
+        fixes = []
+        for row in db.session.query(User.id, *[getattr(User, column) for column in columns]).yield_per(1000):
+            wanted = expected.get(row.id, {})
+            for column in columns:
+                value = wanted.get(column, 0)
+                if getattr(row, column) != value:
+                    print(f"users {row.id}: {column} = {getattr(row, column)}, esperado {value}")
+                    fixes.append((row.id, column, value))
+
+        if check:
+            print(f"{len(fixes)} contadores desajustados.")
+            if fixes:
+                raise SystemExit(1)
+            return
+        for user_id, column, value in fixes:
+            db.session.query(User).filter(User.id == user_id).update({column: value}, synchronize_session=False)
+        db.session.commit()
+        print(f"{len(fixes)} contadores corregidos.")
+
+@app.cli.command("rebuild-timelines")
+@click.option('--check', is_flag=True, help='Solo informa de las entradas que faltan, sin escribirlas.')
+@click.option('--batch-size', default=200, show_default=True, help='Parejas de contactos por lote; cada lote es una transacción.')
+def rebuild_timelines_command(check, batch_size):
+    """Rellena los timelines de contactos con la actividad reciente de cada pareja aceptada (p. ej. las existentes al desplegar)."""
+    with app.app_context():
+        fanout_on_read_ids = {row[0] for row in db.session.query(User.id).filter(User.timeline_fanout_on_read == True)}
+        missing, last_id = 0, 0
+        while True:
+            pairs = db.session.query(Contact.id, Contact.solicitante_id, Contact.receptor_id).filter(
+                Contact.estado == 'aceptado', Contact.id > last_id
+            ).order_by(Contact.id).limit(batch_size).all()
+            if not pairs:
+                break
+            for _contact_id, user_a_id, user_b_id in pairs:
+                for reader_id, author_id in ((user_a_id, user_b_id), (user_b_id, user_a_id)):
+                    if author_id in fanout_on_read_ids:
+                        continue  # Sus lectores leen su actividad al vuelo.
+                    entries = missing_timeline_entries([reader_id], author_id)
+                    if entries and check:
+                        print(f"timeline {reader_id}: faltan {len(entries)} entradas de {author_id}")
+                    missing += len(entries)
+                    if not check:
+                        insert_timeline_entries(entries)
+            if not check:
+                db.session.commit()
+            last_id = pairs[-1][0]
+
+        if check:
+            print(f"{missing} entradas de timeline que faltan.")
+            if missing:
+                raise SystemExit(1)
+            return
+        print(f"{missing} entradas de timeline añadidas.")
+
+@app.cli.command("render-content-html")
+@click.option('--all', 'render_all', is_flag=True, help='Regenera también las filas que ya tienen HTML (p. ej. tras cambiar el formato).')
+@click.option('--batch-size', default=500, show_default=True, help='Filas por lote; cada lote es una transacción.')
+def render_content_html_command(render_all, batch_size):
+    """Rellena el HTML guardado de publicaciones, comentarios y citas creados antes de guardarse."""
+    with app.app_context(), app.test_request_context():  # url_for necesita un contexto de petición
+        for model, text_column, html_column in ((Post, Post.content, Post.content_html),
+                                                (Comment, Comment.content, Comment.content_html),
+                                                (SharedPost, SharedPost.quote_content, SharedPost.quote_content_html)):
+            rendered, last_id = 0, 0
+            while True:
+                batch_q = model.query.filter(model.id > last_id, text_column != None)
+                if not render_all:
+                    batch_q = batch_q.filter(html_column == None)
+                batch = batch_q.order_by(model.id).limit(batch_size).all()
+                if not batch:
+                    break
+                for item in batch:
+                    setattr(item, html_column.key, render_content_html(getattr(item, text_column.key)))
+                last_id = batch[-1].id
+                rendered += len(batch)
+                db.session.commit()
+            print(f"{model.__tablename__}: {rendered} filas renderizadas.")
+
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """Crea los índices de texto completo si faltan y, en SQLite, vuelve a llenar las tablas FTS5."""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            create_search_index(db.metadata, connection)
+            if connection.dialect.name == 'sqlite':
+                for fts_table, table, column, condition in (('posts_fts', 'posts', 'content', 'is_visible'),
+                                                            ('shared_posts_fts', 'shared_posts', 'quote_content', 'quote_content IS NOT NULL')):
+                    connection.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('delete-all')"))
+                    connection.execute(text(f"INSERT INTO {fts_table}(rowid, {column}) SELECT id, {column} FROM {table} WHERE {condition}"))
+        print(f"Índice de búsqueda listo ({db.engine.dialect.name}).")
+
+@app.cli.command("rebuild-hashtags")
+@click.option('--batch-size', default=500, show_default=True, help='Publicaciones o citas por lote.')
+def rebuild_hashtags_command(batch_size):
+    """Vuelve a extraer los hashtags de todas las publicaciones y citas y recalcula las franjas de tendencias."""
+    with app.app_context():
+        db.session.query(HashtagBucket).delete(synchronize_session=False)
+        db.session.query(PostHashtag).delete(synchronize_session=False)
+        db.session.commit()
+
+        bucket_counts = {}
+        sources = (
+            ('original_post', db.session.query(Post.id, Post.id, Post.user_id, Post.timestamp, Post.content, Post.is_visible)),
+            ('shared_post', db.session.query(SharedPost.id, SharedPost.original_post_id, SharedPost.user_id, SharedPost.timestamp,
+                                             SharedPost.quote_content, Post.is_visible).join(Post, Post.id == SharedPost.original_post_id)),
+        )
+        for item_type, source_q in sources:
+            indexed, last_id = 0, 0
+            id_col = Post.id if item_type == 'original_post' else SharedPost.id
+            while True:
+                batch = source_q.filter(id_col > last_id).order_by(id_col).limit(batch_size).all()
+                if not batch:
+                    break
+                rows = []
+                for item_id, post_id, author_id, timestamp, content, is_visible in batch:
+                    names = extract_hashtags(content)
+                    if not names or not timestamp:
+                        continue
+                    hashtag_ids = get_or_create_hashtags(names)
+                    rows.extend({'hashtag_id': hashtag_ids[name], 'item_type': item_type, 'item_id': item_id, 'post_id': post_id,
+                                 'author_id': author_id, 'activity_timestamp': timestamp} for name in names)
+                    # Las publicaciones ocultas siguen indexadas, pero no cuentan en las tendencias.
+                    if is_visible:
+                        bucket_start = hashtag_bucket_start(timestamp)
+                        for hashtag_id in hashtag_ids.values():
+                            bucket_counts[(hashtag_id, bucket_start)] = bucket_counts.get((hashtag_id, bucket_start), 0) + 1
+                    indexed += 1
+                if rows:
+                    db.session.execute(db.insert(PostHashtag), rows)
+                db.session.commit()
+                last_id = batch[-1][0]
+            print(f"{item_type}: {indexed} elementos con hashtags.")
+
+        if bucket_counts:
+            db.session.execute(db.insert(HashtagBucket), [
+                {'hashtag_id': hashtag_id, 'bucket_start': bucket_start, 'count': count}
+                for (hashtag_id, bucket_start), count in bucket_counts.items()
+            ])
+        db.session.commit()
+        _trending_cache.clear()
+        print(f"Franjas de tendencias recalculadas: {len(bucket_counts)}.")
+
+@app.cli.command("backfill-conversation-pairs")
+def backfill_conversation_pairs_command():
+    """
+    Rellena la clave (min_user_id, max_user_id) de las conversaciones directas creadas antes de existir.
+    Es opcional: iniciar_conversacion reclama la clave de una conversación antigua al abrirla. Para migrar una base
+    existente, el orden es backfill-conversation-pairs, migrate-read-cursors, rebuild-conversation-summaries
+    y reconcile-unread-counters.
+    """
+    with app.app_context():
+        pairs = db.session.query(
+            ConversationParticipant.conversation_id,
+            func.min(ConversationParticipant.user_id),
+            func.max(ConversationParticipant.user_id)
+        ).join(Conversation, Conversation.id == ConversationParticipant.conversation_id).filter(
+            Conversation.min_user_id == None
+        ).group_by(
+            ConversationParticipant.conversation_id, Conversation.updated_at
+        ).having(func.count(ConversationParticipant.id) == 2).order_by(Conversation.updated_at.desc()).all()
+
+        taken = set(db.session.query(Conversation.min_user_id, Conversation.max_user_id).filter(Conversation.min_user_id != None))
+        updated, duplicates = 0, 0
+        # Si una pareja tiene varias conversaciones duplicadas, la clave se la queda la de actividad más reciente.
+        for conversation_id, low_id, high_id in pairs:
+            if (low_id, high_id) in taken:
+                duplicates += 1
+                print(f"conversations {conversation_id}: duplicada de la pareja ({low_id}, {high_id}), se deja sin clave")
+                continue
+            taken.add((low_id, high_id))
+            db.session.query(Conversation).filter(Conversation.id == conversation_id).update(
+                {Conversation.min_user_id: low_id, Conversation.max_user_id: high_id}, synchronize_session=False
+            )
+            updated += 1
+        db.session.commit()
+        print(f"{updated} conversaciones actualizadas, {duplicates} duplicadas sin clave.")
+
+@app.cli.command("migrate-read-cursors")
+def migrate_read_cursors_command():
+    """
+    Inicializa last_read_message_id de cada participante a partir de los antiguos flags is_read de los mensajes.
+    Va después de backfill-conversation-pairs y antes de rebuild-conversation-summaries; mientras tanto, abrir
+    una conversación sin resumen ya avanza el cursor hasta su último mensaje.
+    """
+    with app.app_context():
+        last_read = db.session.query(func.max(Message.id)).filter(
+            Message.conversation_id == ConversationParticipant.conversation_id,
+            Message.sender_id != ConversationParticipant.user_id,
+            Message.is_read == True
+        ).scalar_subquery()
+        migrated = db.session.query(ConversationParticipant).filter(
+            ConversationParticipant.last_read_message_id == None
+        ).update({ConversationParticipant.last_read_message_id: last_read}, synchronize_session=False)
+        db.session.commit()
+        print(f"{migrated} participantes migrados. Ejecuta rebuild-conversation-summaries y reconcile-unread-counters para recalcular los no leídos.")
+
+@app.cli.command("rebuild-conversation-summaries")
+@click.option('--check', is_flag=True, help='Solo informa de los resúmenes desajustados, sin corregirlos.')
+def rebuild_conversation_summaries_command(check):
+    """
+    Recalcula el resumen de la bandeja de entrada (último mensaje y no leídos) de cada participante.
+    Los resúmenes sin inicializar ya se calculan al vuelo en la bandeja y al llegar un mensaje; este comando los
+    deja guardados y corrige desajustes. Se ejecuta después de migrate-read-cursors.
+    """
+    with app.app_context():
+        expected = compute_conversation_summaries()
+        columns = ['last_message_id', 'last_message_preview', 'last_message_at', 'unread_count']
+
+        fixes = []
+        for row in db.session.query(ConversationParticipant.id, *[getattr(ConversationParticipant, column) for column in columns]).yield_per(1000):
+            wanted = expected.get(row.id, {})
+            changes = {column: wanted.get(column) for column in columns if getattr(row, column) != wanted.get(column)}
+            if changes:
+                print(f"conversation_participants {row.id}: {', '.join(changes)} desajustados")
+                fixes.append((row.id, changes))
+
+        if check:
+            print(f"{len(fixes)} resúmenes desajustados.")
+            if fixes:
+                raise SystemExit(1)
+            return
+        for participant_id, changes in fixes:
+            db.session.query(ConversationParticipant).filter(ConversationParticipant.id == participant_id).update(changes, synchronize_session=False)
+        db.session.commit()
+        print(f"{len(fixes)} resúmenes corregidos.")
+
 @app.route('/api/report/content', methods=['POST'])
 @login_required_api
 def report_content():
@@ -1890,13 +4182,39 @@ def report_content():
 @app.route('/api/notificacion/marcar_leida/<int:notificacion_id>', methods=['POST'])
 @login_required_api
 def marcar_notificacion_leida(notificacion_id):
-    notif = db.session.query(Notification).filter_by(id=notificacion_id, user_id=session['user_id']).first()
-    if notif and not notif.leida:
-        notif.leida = True
+    user_id_actual = session['user_id']
+    # UPDATE condicional: si dos peticiones llegan a la vez solo una la marca, y el contador baja según las filas cambiadas.
+    marked_read = db.session.query(Notification).filter(
+        Notification.id == notificacion_id, Notification.user_id == user_id_actual, Notification.leida == False
+    ).update({Notification.leida: True}, synchronize_session=False)
+    if marked_read:
+        increment_counter(User, user_id_actual, User.unread_notifications_count, -marked_read)
         db.session.commit()
         return jsonify(success=True)
     return jsonify(success=False), 404
 
+@app.route('/api/notificaciones/marcar_leidas', methods=['POST'])
+@login_required_api
+def marcar_notificaciones_leidas():
+    """Marca como leídas en un solo UPDATE todas las notificaciones no leídas, o solo las anteriores a `hasta` (cursor)."""
+    user_id_actual = session['user_id']
+    data = request.get_json(silent=True) or {}
+    notifications_q = db.session.query(Notification).filter(Notification.user_id == user_id_actual, Notification.leida == False)
+    if data.get('hasta'):
+        position = decode_feed_cursor(data['hasta'])
+        if not position:
+            return jsonify(success=False, error=_('Cursor no válido.')), 400
+        notifications_q = notifications_q.filter(or_(
+            Notification.timestamp < position[0], and_(Notification.timestamp == position[0], Notification.id <= position[1])
+        ))
+
+    marked_read = notifications_q.update({Notification.leida: True}, synchronize_session=False)
+    if marked_read:
+        increment_counter(User, user_id_actual, User.unread_notifications_count, -marked_read)
+    db.session.commit()
+    unread_count = db.session.query(User.unread_notifications_count).filter(User.id == user_id_actual).scalar() or 0
+    return jsonify(success=True, marked_read=marked_read, unread_count=max(unread_count, 0))
+
 @app.route('/api/mensajes/enviar', methods=['POST'])
 @check_sanctions_and_block_api
 def api_enviar_mensaje():
@@ -1913,31 +4231,152 @@ def api_enviar_mensaje():
         return jsonify(success=False, error=_("No tienes permiso para esta conversación.")), 403
 
     other_participant = db.session.query(ConversationParticipant).filter(ConversationParticipant.conversation_id == conversation_id, ConversationParticipant.user_id != user_id_actual).first()
-    if other_participant:
-        excluded_ids = get_blocked_and_blocking_ids(user_id_actual)
-        if other_participant.user_id in excluded_ids:
-            return jsonify(success=False, error=_("No puedes enviar mensajes a este usuario.")), 403
+    if other_participant and is_blocked_between(user_id_actual, other_participant.user_id):
+        return jsonify(success=False, error=_("No puedes enviar mensajes a este usuario.")), 403
     
     try:
         timestamp_actual = datetime.now(timezone.utc)
         new_message = Message(conversation_id=conversation_id, sender_id=user_id_actual, body=body, timestamp=timestamp_actual)
         db.session.add(new_message)
         participant.conversation.updated_at = timestamp_actual
-        db.session.commit()
-        
-        sender_profile = db.session.query(Profile).filter_by(user_id=user_id_actual).first()
-        
-        return jsonify(success=True, message={
-            'id': new_message.id, 'sender_id': user_id_actual, 'body': body,
+        db.session.flush()
+        # Resumen de la bandeja de ambos participantes en un solo UPDATE; solo el receptor suma un no leído.
+        db.session.query(ConversationParticipant).filter(ConversationParticipant.conversation_id == conversation_id).update({
+            ConversationParticipant.last_message_id: new_message.id,
+            ConversationParticipant.last_message_preview: message_preview(body),
+            ConversationParticipant.last_message_at: timestamp_actual,
+            ConversationParticipant.unread_count: case(
+                # Resumen sin inicializar (conversación anterior al resumen): se cuenta desde los mensajes.
+                (ConversationParticipant.last_message_id == None, unread_messages_count_select()),
+                (ConversationParticipant.user_id != user_id_actual, ConversationParticipant.unread_count + 1),
+                else_=ConversationParticipant.unread_count
+            )
+        }, synchronize_session=False)
+
+        sender_profile = get_current_user().profile
+        message_data = {
+            'id': new_message.id, 'conversation_id': new_message.conversation_id, 'sender_id': user_id_actual, 'body': body,
             'timestamp': timestamp_actual.strftime('%Y-%m-%d %H:%M:%S'),
             'username': sender_profile.username if sender_profile else _("Usuario"),
             'photo': sender_profile.photo if sender_profile else None
-        })
+        }
+        # El evento lleva solo ids y un resumen (el cuerpo no tiene límite y NOTIFY sí); la conversación abierta
+        # pide el mensaje completo a /api/mensajes/<id>/nuevos.
+        event_data = {
+            'message_id': new_message.id, 'conversation_id': new_message.conversation_id, 'sender_id': user_id_actual,
+            'preview': message_preview(body)
+        }
+        events = [(conversation_channel(conversation_id), 'message', event_data)]
+        if other_participant:
+            increment_counter(User, other_participant.user_id, User.unread_messages_count)
+            events.append((other_participant.user_id, 'message', event_data))
+        publish_events(events)
+        db.session.commit()
+        
+        return jsonify(success=True, message=message_data)
     except Exception as e:
         db.session.rollback()
         print(f"Error al enviar mensaje: {e}")
         return jsonify(success=False, error=_("Error al enviar el mensaje.")), 500
 
+@app.route('/api/mensajes/<int:conversation_id>/anteriores')
+@login_required_api
+def api_mensajes_anteriores(conversation_id):
+    """Devuelve la página de mensajes anterior a un cursor, en orden cronológico."""
+    user_id_actual = session['user_id']
+    participant = db.session.query(ConversationParticipant.id).filter_by(conversation_id=conversation_id, user_id=user_id_actual).first()
+    if not participant:
+        return jsonify(success=False, error=_("No tienes permiso para esta conversación.")), 403
+
+    cursor = request.args.get('cursor', '').strip()
+    if not decode_feed_cursor(cursor):
+        return jsonify(success=False, error='invalid_cursor'), 400
+
+    messages, older_cursor = load_messages_page(conversation_id, cursor=cursor)
+    return jsonify(success=True, older_cursor=older_cursor, messages=[{
+        'id': msg.id, 'sender_id': msg.sender_id, 'body': msg.body,
+        'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    } for msg in messages])
+
+@app.route('/api/mensajes/<int:conversation_id>/nuevos')
+@login_required_api
+def api_mensajes_nuevos(conversation_id):
+    """Devuelve los mensajes posteriores a un id, en orden cronológico (los eventos SSE solo llevan el id)."""
+    user_id_actual = session['user_id']
+    participant = db.session.query(ConversationParticipant.id).filter_by(conversation_id=conversation_id, user_id=user_id_actual).first()
+    if not participant or other_participant_blocked(conversation_id, user_id_actual):
+        return jsonify(success=False, error=_("No tienes permiso para esta conversación.")), 403
+
+    after_id = request.args.get('despues', 0, type=int)
+    messages = db.session.query(Message).filter(
+        Message.conversation_id == conversation_id, Message.id > after_id
+    ).order_by(Message.id.asc()).limit(MESSAGES_PER_PAGE).all()
+    return jsonify(success=True, messages=[{
+        'id': msg.id, 'sender_id': msg.sender_id, 'body': msg.body,
+        'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    } for msg in messages])
+
+def other_participant_blocked(conversation_id, user_id):
+    """True si el otro participante de la conversación y el usuario tienen un bloqueo en cualquier sentido."""
+    other_user_id = db.session.query(ConversationParticipant.user_id).filter(
+        ConversationParticipant.conversation_id == conversation_id,
+        ConversationParticipant.user_id != user_id
+    ).scalar()
+    return bool(other_user_id) and is_blocked_between(user_id, other_user_id)
+
+@app.route('/mensajes/<int:conversation_id>/stream')
+@login_required_api
+def stream_conversacion(conversation_id):
+    """Canal SSE de una conversación abierta: mensajes nuevos, avisos de escritura y cambios del cursor de lectura."""
+    user_id_actual = session['user_id']
+    participant = db.session.query(ConversationParticipant.id).filter_by(conversation_id=conversation_id, user_id=user_id_actual).first()
+    if not participant or other_participant_blocked(conversation_id, user_id_actual):
+        return Response(status=403)
+    return sse_response(conversation_channel(conversation_id))
+
+@app.route('/api/mensajes/<int:conversation_id>/escribiendo', methods=['POST'])
+@login_required_api
+def api_mensaje_escribiendo(conversation_id):
+    """Avisa al otro participante de que el usuario está escribiendo. No se guarda nada."""
+    user_id_actual = session['user_id']
+    participant = db.session.query(ConversationParticipant.id).filter_by(conversation_id=conversation_id, user_id=user_id_actual).first()
+    if not participant:
+        return jsonify(success=False, error=_("No tienes permiso para esta conversación.")), 403
+    if other_participant_blocked(conversation_id, user_id_actual):
+        return jsonify(success=False, error=_("No puedes enviar mensajes a este usuario.")), 403
+    publish_event(conversation_channel(conversation_id), 'typing', {'user_id': user_id_actual})
+    db.session.commit()
+    return jsonify(success=True)
+
+@app.route('/api/mensajes/<int:conversation_id>/leido', methods=['POST'])
+@login_required_api
+def api_marcar_conversacion_leida(conversation_id):
+    """Avanza el cursor de lectura hasta un mensaje recibido con la conversación abierta."""
+    user_id_actual = session['user_id']
+    participant = ConversationParticipant.query.filter_by(conversation_id=conversation_id, user_id=user_id_actual).first()
+    if not participant:
+        return jsonify(success=False, error=_("No tienes permiso para esta conversación.")), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        message_id = int(data.get('message_id'))
+    except (TypeError, ValueError):
+        return jsonify(success=False, error=_("Faltan datos.")), 400
+
+    other_user_id = db.session.query(ConversationParticipant.user_id).filter(
+        ConversationParticipant.conversation_id == conversation_id,
+        ConversationParticipant.user_id != user_id_actual
+    ).scalar()
+    try:
+        mark_conversation_read(participant, message_id, other_user_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al marcar la conversación como leída: {e}")
+        return jsonify(success=False, error=_("Error al marcar la conversación como leída.")), 500
+    return jsonify(success=True, last_read_message_id=participant.last_read_message_id,
+                   unread_count=max(get_current_user().unread_messages_count, 0))
+
 @app.route('/api/users/mention_search')
 @login_required_api
 def mention_search():
@@ -1946,35 +4385,52 @@ def mention_search():
         return jsonify([])
 
     current_user_id = session['user_id']
-    excluded_ids = get_blocked_and_blocking_ids(current_user_id)
-    excluded_ids.add(current_user_id)
 
-    query_filter = or_(Profile.username.ilike(f'%{search_term}%'), Profile.slug.ilike(f'%{search_term}%'))
-    
-    users_found = db.session.query(Profile).filter(query_filter, Profile.user_id.notin_(excluded_ids), Profile.username != None, Profile.slug != None).order_by(Profile.username.asc()).limit(10).all()
-    
+    # Índice de prefijos en memoria del worker; no consulta la base de datos en cada pulsación
     suggestions = [{
-        'username': p.username, 
-        'slug': p.slug, 
-        'photo': url_for('static', filename=f'uploads/{p.photo}') if p.photo else None
-    } for p in users_found]
+        'username': p['username'],
+        'slug': p['slug'],
+        'photo': url_for('static', filename=f"uploads/{p['photo']}") if p['photo'] else None
+    } for p in mention_index.suggest(search_term, current_user_id)]
     
     return jsonify(suggestions)
 
+def sse_response(channel, initial_events=()):
+    """Respuesta SSE que envía `initial_events` y después los eventos del canal en el broker, con keepalive."""
+    def event_stream():
+        events = event_broker.subscribe(channel)
+        try:
+            for event_name, data in initial_events:
+                yield f"event: {event_name}\ndata: {json.dumps(data)}\n\n"
+            while True:
+                try:
+                    message = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+        finally:
+            event_broker.unsubscribe(channel, events)
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/stream-notifications')
 def stream_notifications():
     if 'user_id' not in session:
         return Response(status=401)
     
     user_id = session['user_id']
-    def event_stream():
-        # Esta función puede permanecer como está, ya que su lógica de BBDD es simple y se reescribirá
-        # al refactorizar el context_processor, que es la fuente de sus datos.
-        # Por ahora, la dejamos para no introducir más cambios simultáneos.
-        # En una refactorización final, usaríamos directamente las queries de SQLAlchemy aquí.
-        # ... (código existente de event_stream) ...
-        pass
-    return Response(event_stream(), mimetype='text/event-stream')
+    user = get_current_user()
+    if not user:
+        return Response(status=401)
+    # Los contadores se leen ahora; durante el stream no se usa la base de datos, solo el broker.
+    unread_counts = {
+        'notificaciones': max(user.unread_notifications_count, 0),
+        'mensajes': max(user.unread_messages_count, 0)
+    }
+
+    return sse_response(user_id, [('unread_counts', unread_counts)])
 
 @app.route('/privacy')
 def privacy_policy():
@@ -1989,7 +4445,7 @@ def terms_of_service():
 @app.route('/accept-policies', methods=['GET', 'POST'])
 @login_required
 def accept_policies():
-    user = db.session.query(User).get(session['user_id'])
+    user = get_current_user()
     # Si ya las aceptó, redirigir al feed.
     if user.accepted_policies:
         return redirect(url_for('feed'))
@@ -2037,7 +4493,7 @@ def resolve_appeal(appeal_id):
 @coordinator_or_admin_required
 def admin_users_list():
     users_list = User.query.options(joinedload(User.profile)).order_by(User.id.asc()).all()
-    current_user = User.query.get(session['user_id'])
+    current_user = get_current_user()
     return render_template('admin/users_list.html', users_list=users_list, current_user_role=current_user.role)
 
 @app.route('/admin/user/<int:user_id>/set_role', methods=['POST'])
@@ -2047,7 +4503,7 @@ def admin_set_user_role(user_id):
         flash(_('No puedes cambiar tu propio rol.'), 'danger')
         return redirect(url_for('admin_users_list'))
 
-    actor = User.query.get(session['user_id'])
+    actor = get_current_user()
     target_user = User.query.get(user_id)
     if not target_user:
         flash(_("El usuario que intentas modificar no existe."), 'danger')
@@ -2172,6 +4628,10 @@ def admin_edit_post(post_id):
             flash(_('El contenido de la publicación no puede estar vacío.'), 'danger')
         else:
             post.content = new_content
+            post.content_html = render_content_html(new_content)
+            # Solo cambian los hashtags de la propia publicación; las citas que la comparten conservan los suyos.
+            unindex_hashtags('original_post', post.id, count_in_trending=post.is_visible)
+            index_hashtags('original_post', post.id, post.id, post.user_id, post.timestamp, new_content, count_in_trending=post.is_visible)
             log_details = f"Editó el post ID {post_id}. Contenido anterior: '{original_content[:100]}...'"
             log_admin_action(session['user_id'], 'POST_EDIT_BY_MOD', target_content_id=post_id, details=log_details)
             db.session.commit()
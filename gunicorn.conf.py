@@ -0,0 +1,23 @@
+# Configuración de gunicorn para producción (ver Procfile).
+#
+# Los workers de gevent atienden cada petición en una greenlet, así que una conexión SSE
+# (/stream-notifications) o una petición lenta a generate_link_preview solo ocupan una greenlet
+# en espera, no un worker entero. Con WEB_CONCURRENCY workers y WORKER_CONNECTIONS conexiones
+# por worker, un nodo puede mantener decenas de miles de clientes SSE inactivos (el límite
+# real lo marca `ulimit -n`).
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 10000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 75
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    # gunicorn ya aplica monkey.patch_all() al arrancar un worker de gevent; psycopg2 es una
+    # extensión en C y necesita además este parche para ceder el control mientras espera a Postgres.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()